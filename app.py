@@ -26,10 +26,24 @@
 # see Evernote "Python Audio" also..
 
 import sys
+import os
 from os import path
 import logging
-from time import sleep
+from time import sleep, monotonic, time
 import subprocess
+import threading
+import heapq
+import itertools
+import bisect
+import uuid
+import random
+import socket
+import fcntl
+import errno
+from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from pprint import pprint
 
@@ -39,39 +53,108 @@ sd = sdnotify.SystemdNotifier()
 
 # static configuration
 MQTT_TOPIC_PREFIX = "audio"
+# playback topics whose duplicates within coalesce_window play once
+COALESCED_TOPICS = tuple(f"{MQTT_TOPIC_PREFIX}/{name}" 
+    for name in ("play", "speak", "speech", "announcement"))
+# first topic levels that cannot double as zone names
+ZONE_RESERVED_NAMES = ["set", "speak", "speech", "play", "announcement", "stats", "status",
+    "presynthesize"]
 SOUNDS_PATH = "/opt/sounds"
 CACHE_PATH = "/opt/sounds/cache"
-TTS_WAVEFORM_DB_PATH = "database.json"
+TTS_WAVEFORM_DB_PATH = "database.jsonl"
+TTS_WAVEFORM_LEGACY_DB_PATH = "database.json"
 SUPPORTED_FORMATS = ['wav']
 PREFERRED_FORMAT = 'wav'
+# target of every conversion into the cache (signed 16-bit pcm) when the 
+#  output device's native format cannot be determined
+CONVERSION_CHANNELS = 1
+CONVERSION_SAMPLE_RATE = 44100
+# preferred rates and channel counts when a device accepts a range of either
+NATIVE_SAMPLE_RATES = [48000, 44100]
+NATIVE_CHANNELS = [2, 1]
 TTS_DEFAULT_VOICE = "Matthew"
 
+# streaming tts; polly returns signed 16-bit little-endian mono pcm
+PCM_SAMPLE_RATE = 16000
+PCM_CHUNK_SIZE = 4096
+
+# playback request priorities; lower value plays first
+PRIORITY_URGENT = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+PRIORITIES = {
+    "urgent": PRIORITY_URGENT,
+    "high": PRIORITY_HIGH,
+    "normal": PRIORITY_NORMAL,
+    "low": PRIORITY_LOW,
+}
+
 import paho.mqtt.client as mqtt # pip3 paho-mqtt
 
 import configparser
 import argparse
 import json
+import re
+import hashlib
+import math
+from datetime import datetime
+import wave
+import tempfile
+import tracemalloc
+import mmap
+from collections import deque, OrderedDict
 
 from pathlib import Path
 
+import importlib
+
+# Stands in for a module that is only imported on first attribute access, so
+#  the TTS and conversion stacks do not slow down startup (or pool workers
+#  that never use them)
+class LazyModule():
+
+    def __init__(self,name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self,attr):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return getattr(module, attr)
+
 # Audio Modules
-import simpleaudio
-import alsaaudio as alsa # pip3 pyalsaaudio
+simpleaudio = LazyModule("simpleaudio")
+alsa = LazyModule("alsaaudio") # pip3 pyalsaaudio
 
 # Polly TTS Engine
-import boto3
-from botocore.config import Config
+boto3 = LazyModule("boto3")
+botocore_config = LazyModule("botocore.config")
 
 # audio conversions
-import miniaudio # pip3
+miniaudio = LazyModule("miniaudio") # pip3
 import array
 
+# software gain and loudness
+import numpy as np # pip3
+
+# optional; without it the sound library index falls back to polling
+try:
+    import inotify_simple # pip3 inotify_simple
+except ImportError:
+    inotify_simple = None
+
 # config
 config = configparser.ConfigParser()
 config.read('config.ini')
 
 baseVolume = config['general']['base_volume']
 
+# streaming (bounded memory) or buffered (whole file) conversions
+conversionMode = config.get('general', 'conversion', fallback='streaming')
+
 # 
 # Scale volume from a provided 0 - 100
 # to vol_absolute_min to vol_absolute_max
@@ -85,17 +168,201 @@ def getScaledVolume(value):
     val = int(((int(value) / 100) * (volAbsMax - volAbsMin)) + volAbsMin)
     return val
 
+# Optional pack file store for TTS audio. Instead of a wav (and ogg) per 
+#  phrase, PCM segments are appended to a few large pack files and found 
+#  through an offset index (an append-only journal like the TTS database).
+#  Reads return a memoryview into an mmap of the pack, so playback does not
+#  copy the audio out of the page cache. Deleted segments stay in their pack
+#  until compaction rewrites packs that are mostly garbage.
+class PackStore():
+
+    PACK_PATTERN = "pack-%05d.bin"
+    INDEX = "pack.index"
+
+    def __init__(self,path,pack_size=64*1024*1024):
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.pack_size = pack_size
+        self.index_path = self.path / self.INDEX
+        self.lock = threading.Lock()
+        # name -> {"pack", "offset", "length", "channels", "width", "rate"}
+        self.segments = {}
+        self.maps = {}
+        self.index_records = 0
+
+        if self.index_path.exists():
+            with open(self.index_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.index_records += 1
+                    if record.pop("op") == "put":
+                        self.segments[record.pop("name")] = record
+                    else:
+                        self.segments.pop(record["name"], None)
+
+        packs = sorted(self.path.glob("pack-*.bin"))
+        self.current = int(packs[-1].stem[5:]) if packs else 1
+        self.index = open(self.index_path, 'a')
+
+    def pack_path(self,pack):
+        return self.path / (self.PACK_PATTERN % pack)
+
+    def __contains__(self,name):
+        return name in self.segments
+
+    def append_index(self,record):
+        self.index.write(json.dumps(record) + "\n")
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.index_records += 1
+
+    def put(self,name,pcm,channels,width,rate):
+        with self.lock:
+            pack_path = self.pack_path(self.current)
+            if pack_path.exists() and pack_path.stat().st_size + len(pcm) > self.pack_size:
+                self.current += 1
+                pack_path = self.pack_path(self.current)
+            with open(pack_path, 'ab') as f:
+                offset = f.tell()
+                f.write(pcm)
+                f.flush()
+                os.fsync(f.fileno())
+            segment = {"pack": self.current, "offset": offset, "length": len(pcm),
+                "channels": channels, "width": width, "rate": rate}
+            self.segments[name] = segment
+            self.append_index(dict(segment, op="put", name=name))
+
+    def delete(self,name):
+        with self.lock:
+            if self.segments.pop(name, None) is not None:
+                self.append_index({"op": "del", "name": name})
+
+    def size_of(self,name):
+        segment = self.segments.get(name)
+        return segment["length"] if segment else 0
+
+    # (memoryview, channels, width, rate) of a segment, read through mmap
+    def get(self,name):
+        with self.lock:
+            segment = self.segments.get(name)
+            if not segment:
+                return None
+            end = segment["offset"] + segment["length"]
+            mapped = self.maps.get(segment["pack"])
+            if mapped is None or len(mapped) < end:
+                # the pack has grown since it was mapped
+                with open(self.pack_path(segment["pack"]), 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment["pack"]] = mapped
+        view = memoryview(mapped)[segment["offset"]:end]
+        return view, segment["channels"], segment["width"], segment["rate"]
+
+    def live_segments(self,pack):
+        with self.lock:
+            return [name for name, segment in self.segments.items() 
+                if segment["pack"] == pack]
+
+    # bytes the packs take on disk, dead segments included
+    def disk_bytes(self):
+        return sum(p.stat().st_size for p in self.path.glob("pack-*.bin"))
+
+    # rewrite every pack whose live segments take up less than min_live of
+    #  it; the pack being appended to is first closed off by starting a new
+    #  one. Returns the bytes that left the disk.
+    def compact(self,min_live=0.5):
+        reclaimed = 0
+        packs = sorted(int(p.stem[5:]) for p in self.path.glob("pack-*.bin"))
+        for pack in packs:
+            pack_path = self.pack_path(pack)
+            size = pack_path.stat().st_size
+            used = sum(self.size_of(name) for name in self.live_segments(pack))
+            if size and used / size >= min_live:
+                continue
+            with self.lock:
+                if pack == self.current:
+                    if not size:
+                        continue
+                    self.current += 1
+            # nothing more is appended to this pack
+            size = pack_path.stat().st_size
+            names = self.live_segments(pack)
+            used = sum(self.size_of(name) for name in names)
+            for name in names:
+                found = self.get(name)
+                if found:
+                    view, channels, width, rate = found
+                    self.put(name, bytes(view), channels, width, rate)
+            with self.lock:
+                # segments still being played keep the old mapping alive
+                #  until they are released; unlinking does not disturb them
+                self.maps.pop(pack, None)
+                pack_path.unlink()
+            reclaimed += size - used
+            logger.info("pack store: compacted %s (%d of %d bytes live)" 
+                % (pack_path.name, used, size))
+        if self.index_records > 2 * len(self.segments):
+            self.rewrite_index()
+        return reclaimed
+
+    def rewrite_index(self):
+        with self.lock:
+            tmp_path = self.index_path.with_name(".%s" % self.INDEX)
+            with open(tmp_path, 'w') as f:
+                for name, segment in self.segments.items():
+                    f.write(json.dumps(dict(segment, op="put", name=name)) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.index.close()
+            os.replace(tmp_path, self.index_path)
+            self.index = open(self.index_path, 'a')
+            self.index_records = len(self.segments)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "segments": len(self.segments),
+                "packs": len(list(self.path.glob("pack-*.bin"))),
+                "pack_bytes": self.disk_bytes(),
+                "live_bytes": sum(s["length"] for s in self.segments.values()),
+            }
+
+# raised when another process (normally the running bridge) has the TTS 
+#  database open
+class TtsDatabaseLocked(Exception):
+    pass
+
 # Store TTS wave files on disk so we do not hit the server
 #  for subsequent requests for same text
+# Index is an append-only journal (one JSON record per line) keyed by a hash
+#  of (voice, engine, text type, text) and held in a dict for constant time
+#  lookups. A torn final line from a crash is ignored on replay. The journal
+#  is compacted on startup once it carries enough superseded records.
+# Only one process may use the database at a time: the journal is only read
+#  at startup and file numbers are allocated in memory, so an exclusive lock
+#  on <journal>.lock is held for as long as the database is open.
 class TtsWaveformDatabase():
 
-    def __init__(self,db_path):
+    COMPACT_MIN_RECORDS = 100
+
+    def __init__(self,journal_path,legacy_path=None,pack=None):
         
-        self.db_path = db_path
+        self.journal_path = journal_path
+        self.pack = pack
+        self.legacy_path = legacy_path
         self.tts_cache_path = "%s/tts" % CACHE_PATH
         ttsCache = Path(self.tts_cache_path)
         self.filename_base_pattern = self.tts_cache_path + "/tts%05d"
-        
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.filenames = {}
+        self.touched = set()
+        self.journal_records = 0
+        self.last_fileno = 0
+
         # create cache folder if it does not exist
         if ttsCache.exists():
             print(f"Found TTS Cache: {self.tts_cache_path}")
@@ -103,237 +370,3173 @@ class TtsWaveformDatabase():
             print(f"TTS Cache Path not found; Creating {self.tts_cache_path}")
             ttsCache.mkdir(parents=True,exist_ok=True)
         
+        self.lock_file = open("%s.lock" % journal_path, 'a')
         try:
-            with open(db_path) as f:
-                self.data = json.load(f)
-        except FileNotFoundError as e:
-            self.data = {}
-            self.data["tts"] = []
-    
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise TtsDatabaseLocked("'%s' is in use by another process" % journal_path)
+        
+        if Path(journal_path).exists():
+            self.replay()
+        elif legacy_path and Path(legacy_path).exists():
+            self.migrate(legacy_path)
+
+        if (self.journal_records > self.COMPACT_MIN_RECORDS and 
+                self.journal_records > 2 * len(self.entries)):
+            self.compact()
+
+        self.journal = open(self.journal_path, 'a')
+        # terminate a torn final record so the next append starts clean
+        if self.journal.tell() and not self.ends_with_newline():
+            self.journal.write("\n")
+
+    @staticmethod
+    def key(text,voice,engine="neural",text_type="text"):
+        material = "\0".join((voice.lower(), engine, text_type, text))
+        return hashlib.sha1(material.encode('utf-8')).hexdigest()
+
+    def replay(self):
+        with open(self.journal_path, 'rb') as f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("tts journal: skipping unreadable record at line %d" % lineno)
+                    continue
+                self.journal_records += 1
+                self.apply(record)
+        logger.info("tts journal: %d entries from %d records" 
+            % (len(self.entries), self.journal_records))
+
+    def ends_with_newline(self):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def apply(self,record):
+        op = record.pop("op", "add")
+        key = record.get("key")
+        if op == "add":
+            self.entries[key] = record
+            self.filenames[record["filename"]] = key
+            self.note_filename(record["filename"])
+        elif op == "del":
+            tts = self.entries.pop(key, None)
+            if tts:
+                self.filenames.pop(tts["filename"], None)
+        elif op == "touch" and key in self.entries:
+            self.entries[key]["last_used"] = record["last_used"]
+            self.entries[key]["hits"] = record["hits"]
+
+    def note_filename(self,filename):
+        try:
+            fileno = int(Path(filename).name[3:])
+        except ValueError:
+            return
+        self.last_fileno = max(self.last_fileno, fileno)
+
+    # one-time import of the original database.json; the legacy file is kept
+    #  (renamed) in case the migration needs to be redone
+    def migrate(self,legacy_path):
+        with open(legacy_path) as f:
+            data = json.load(f)
+        for tts in data.get("tts", []):
+            voice = tts["voice"]
+            # the legacy format did not record these; Polly always used the 
+            #  neural engine and wrapped Matthew requests in SSML
+            text_type = "ssml" if voice == "matthew" else "text"
+            record = {
+                "key": self.key(tts["text"], voice, "neural", text_type),
+                "text": tts["text"],
+                "voice": voice,
+                "engine": "neural",
+                "text_type": text_type,
+                "filename": tts["filename"].lstrip("/"),
+                "extensions": tts["extensions"],
+            }
+            self.apply(record)
+        self.write_snapshot()
+        Path(legacy_path).rename(str(legacy_path) + ".migrated")
+        logger.info("tts journal: migrated %d entries from %s" 
+            % (len(self.entries), legacy_path))
+
+    # write all live entries to a new journal and atomically swap it in
+    def write_snapshot(self):
+        tmp_path = "%s.tmp" % self.journal_path
+        with open(tmp_path, 'w') as f:
+            for record in self.entries.values():
+                f.write(json.dumps(dict(record, op="add")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self.journal_records = len(self.entries)
+
+    def compact(self):
+        with self.lock:
+            journal = getattr(self, "journal", None)
+            if journal:
+                journal.close()
+            before = self.journal_records
+            self.write_snapshot()
+            if journal:
+                self.journal = open(self.journal_path, 'a')
+        logger.info("tts journal: compacted %d records to %d" 
+            % (before, self.journal_records))
+
+    def append(self,record):
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_records += 1
+
+    # file numbers only ever increase, so a deleted entry never has its 
+    #  files reused or overwritten
     def next_filename(self):
-        fileno = len(self.data["tts"]) + 1
-        return self.filename_base_pattern % fileno
+        with self.lock:
+            self.last_fileno += 1
+            while Path((self.filename_base_pattern % self.last_fileno) + ".wav").exists():
+                self.last_fileno += 1
+            return self.filename_base_pattern % self.last_fileno
     
-    def get_tts(self,text,voice):
-        voice = voice.lower()
-        for tts in self.data["tts"]:
-            if tts["voice"] == voice:
-                if tts["text"] == text:
-                    return self.tts_cache_path + "/" + tts["filename"]
+    def get_tts(self,text,voice,engine="neural",text_type="text",touch=True):
+        tts = self.entries.get(self.key(text, voice, engine, text_type))
+        if tts:
+            if touch:
+                with self.lock:
+                    tts["last_used"] = time()
+                    tts["hits"] = tts.get("hits", 0) + 1
+                    self.touched.add(tts["key"])
+            return self.tts_cache_path + "/" + tts["filename"]
         # else
         return None
+
+    # access times are journaled in batches (see CacheManager) rather than 
+    #  on every play to spare the SD card
+    def flush_access(self):
+        with self.lock:
+            for key in self.touched:
+                tts = self.entries.get(key)
+                if tts:
+                    self.journal.write(json.dumps({"op": "touch", "key": key,
+                        "last_used": tts["last_used"], "hits": tts["hits"]}) + "\n")
+                    self.journal_records += 1
+            self.touched.clear()
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    # loose files of an entry; a packed entry has none
+    def files(self,tts):
+        return [Path("%s/%s.%s" % (self.tts_cache_path, tts["filename"], ext))
+            for ext in tts["extensions"] if ext != "pack"]
+
+    # packed=False leaves out the entry's pack segment, whose space is only
+    #  given back when its pack is compacted
+    def size_of(self,tts,packed=True):
+        size = 0
+        for filepath in self.files(tts):
+            try:
+                size += os.stat(filepath).st_size
+            except FileNotFoundError:
+                pass
+        if packed and self.pack and "pack" in tts["extensions"]:
+            size += self.pack.size_of(tts["filename"])
+        return size
+
+    # remove an entry along with its audio
+    def delete_tts(self,key):
+        tts = self.entries.get(key)
+        if not tts:
+            return
+        self.remove_tts(key)
+        for filepath in self.files(tts):
+            filepath.unlink(missing_ok=True)
+        if self.pack:
+            self.pack.delete(tts["filename"])
+
+    # (pcm buffer, channels, sample width, sample rate) of an entry's audio 
+    #  from the pack store or its wav
+    def read_pcm(self,filename_base):
+        name = Path(filename_base).name
+        if self.pack and name in self.pack:
+            return self.pack.get(name)
+        with wave.open("%s.wav" % filename_base, 'rb') as wav:
+            return (wav.readframes(wav.getnframes()), wav.getnchannels(),
+                wav.getsampwidth(), wav.getframerate())
+
+    # a WaveObject straight from the pack store mmap, if the entry is packed
+    def packed_wave(self,filepath):
+        name = Path(filepath).stem
+        if not self.pack or name not in self.pack:
+            return None
+        pcm, channels, width, rate = self.pack.get(name)
+        return simpleaudio.WaveObject(pcm, channels, width, rate)
+
+    # move an entry's wav into the pack store and drop its loose files
+    def pack_entry(self,key):
+        tts = self.entries.get(key)
+        if not tts or "wav" not in tts["extensions"]:
+            return
+        base = "%s/%s" % (self.tts_cache_path, tts["filename"])
+        pcm, channels, width, rate = self.read_pcm(base)
+        self.pack.put(tts["filename"], pcm, channels, width, rate)
+        files = self.files(tts)
+        with self.lock:
+            tts["extensions"] = ["pack"]
+            self.append(dict(tts, op="add"))
+        for filepath in files:
+            filepath.unlink(missing_ok=True)
+
+    # write a packed entry back out as a wav in the per-file layout
+    def unpack_entry(self,key):
+        tts = self.entries.get(key)
+        if not tts or "pack" not in tts["extensions"]:
+            return
+        pcm, channels, width, rate = self.pack.get(tts["filename"])
+        with wave.open("%s/%s.wav" % (self.tts_cache_path, tts["filename"]), 'wb') as wav:
+            wav.setnchannels(channels)
+            wav.setsampwidth(width)
+            wav.setframerate(rate)
+            wav.writeframes(pcm)
+        with self.lock:
+            tts["extensions"] = ["wav"]
+            self.append(dict(tts, op="add"))
+        self.pack.delete(tts["filename"])
+
+    # Convert every entry not already in audio_format, e.g. after the output
+    #  device has changed. Works from the stored pcm (wav or pack), so it does
+    #  not depend on the ogg still being kept. Entries recorded before formats
+    #  were tracked were converted with the defaults.
+    def rerender(self,audio_format):
+        converted = 0
+        for key in list(self.entries):
+            tts = self.entries.get(key)
+            if not tts or tts.get("format", AudioFormat().params()) == audio_format.params():
+                continue
+            base = "%s/%s" % (self.tts_cache_path, tts["filename"])
+            try:
+                pcm, channels, width, rate = self.read_pcm(base)
+                if not audio_format.matches(channels, width, rate):
+                    pcm = miniaudio.convert_frames(sample_format(width), channels,
+                        rate, bytes(pcm), miniaudio.SampleFormat.SIGNED16,
+                        audio_format.channels, audio_format.sample_rate)
+            except Exception as e:
+                logger.error("unable to re-render '%s': %s" % (tts["filename"], e.__repr__()))
+                continue
+            if "pack" in tts["extensions"]:
+                self.pack.put(tts["filename"], pcm, audio_format.channels, 
+                    AudioFormat.SAMPLE_WIDTH, audio_format.sample_rate)
+            else:
+                tmp_path = "%s/.%s.wav" % (self.tts_cache_path, tts["filename"])
+                with wave.open(tmp_path, 'wb') as wav:
+                    wav.setnchannels(audio_format.channels)
+                    wav.setsampwidth(AudioFormat.SAMPLE_WIDTH)
+                    wav.setframerate(audio_format.sample_rate)
+                    wav.writeframes(pcm)
+                os.replace(tmp_path, "%s.wav" % base)
+                if "wav" not in tts["extensions"]:
+                    tts["extensions"] = ["wav"] + tts["extensions"]
+            with self.lock:
+                tts["format"] = audio_format.params()
+                self.append(dict(tts, op="add"))
+            converted += 1
+        return converted
+
+    def import_to_pack(self):
+        count = 0
+        for key in list(self.entries):
+            if "wav" in self.entries[key]["extensions"]:
+                self.pack_entry(key)
+                count += 1
+        return count
+
+    def export_from_pack(self):
+        count = 0
+        for key in list(self.entries):
+            if "pack" in self.entries[key]["extensions"]:
+                self.unpack_entry(key)
+                count += 1
+        return count
+
+    # drop one copy of an entry's audio, e.g. the ogg once the wav exists
+    def drop_extension(self,key,ext):
+        with self.lock:
+            tts = self.entries.get(key)
+            if not tts or ext not in tts["extensions"] or len(tts["extensions"]) < 2:
+                return
+            tts["extensions"] = [e for e in tts["extensions"] if e != ext]
+            self.append(dict(tts, op="add"))
     
-    def add_tts(self,text,filename,extensions,voice):
+    def entry_for_file(self,filepath):
+        key = self.filenames.get(Path(filepath).stem)
+        return self.entries.get(key) if key else None
+
+    def add_tts(self,text,filename,extensions,voice,engine="neural",text_type="text",
+            loudness=None,audio_format=None):
         tts = {}
+        tts["key"] = self.key(text, voice, engine, text_type)
         tts["text"] = text
-        tts["filename"] = filename.replace(self.tts_cache_path,"")
+        tts["filename"] = Path(filename).name
         tts["voice"] = voice.lower()
+        tts["engine"] = engine
+        tts["text_type"] = text_type
         tts["extensions"] = extensions
-        self.data["tts"].append(tts)
-        self.write_disk()
-        
-    def write_disk(self):
-        with open(self.db_path, 'w') as json_file:
-            json.dump(self.data, json_file, indent=4)
+        tts["last_used"] = time()
+        tts["hits"] = 0
+        tts["format"] = (audio_format or AudioFormat()).params()
+        if loudness:
+            tts.update(loudness)
+        with self.lock:
+            self.entries[tts["key"]] = tts
+            self.filenames[tts["filename"]] = tts["key"]
+            self.append(dict(tts, op="add"))
+        if self.pack:
+            self.pack_entry(tts["key"])
+
+    def remove_tts(self,key):
+        with self.lock:
+            tts = self.entries.pop(key, None)
+            if tts is not None:
+                self.filenames.pop(tts["filename"], None)
+                self.append({"op": "del", "key": key})
     
     def to_json(self):
-        return json.dumps(self.data)
+        return json.dumps({"tts": list(self.entries.values())})
+
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
+    format="%(levelname)s:%(name)s:%(trace)s%(message)s")
+logger = logging.getLogger("AudioBridge")
+
+# -- Instrumentation
+# Each MQTT message gets a short trace id that follows it onto the playback 
+#  worker and is prefixed to every log line written while handling it.
+# Stage timings are collected into fixed-bucket histograms, published as 
+#  json to {MQTT_TOPIC_PREFIX}/stats and written as a Prometheus text file.
+
+trace_context = threading.local()
+
+def new_trace_id():
+    return uuid.uuid4().hex[:8]
+
+def current_trace_id():
+    return getattr(trace_context, "trace_id", None)
+
+def set_trace_id(trace_id):
+    trace_context.trace_id = trace_id
+
+class TraceFilter(logging.Filter):
+    def filter(self,record):
+        trace_id = current_trace_id()
+        record.trace = "[%s] " % trace_id if trace_id else ""
+        return True
+
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceFilter())
+
+class Histogram():
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 
+        1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self,seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # upper bound of the bucket holding the q quantile
+    def quantile(self,q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else float('inf')
+        return float('inf')
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+class Metrics():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self,stage,seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self,stage):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, monotonic() - started)
+
+    def summary(self):
+        with self.lock:
+            return dict((stage, h.summary()) for stage, h in self.histograms.items())
+
+    # Prometheus text exposition format; components is a dict of 
+    #  component -> {name: number} exported as gauges
+    def prometheus(self,components=None):
+        lines = [
+            "# HELP audiobridge_stage_seconds Time spent in each stage of a request",
+            "# TYPE audiobridge_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.BUCKETS + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append('audiobridge_stage_seconds_bucket{stage="%s",le="%s"} %d' 
+                        % (stage, bound, cumulative))
+                lines.append('audiobridge_stage_seconds_sum{stage="%s"} %f' % (stage, h.sum))
+                lines.append('audiobridge_stage_seconds_count{stage="%s"} %d' % (stage, h.count))
+        for component, values in sorted((components or {}).items()):
+            for name, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = "audiobridge_%s_%s" % (component, name)
+                lines.append("# TYPE %s gauge" % metric)
+                lines.append("%s %s" % (metric, value))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self,filename,components=None):
+        tmp_path = "%s.tmp" % filename
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus(components))
+        os.replace(tmp_path, filename)
+
+metrics = Metrics()
+
+# Layout cached audio is converted to; ideally the output device's native 
+#  one so sounds are not resampled again on their way to the speaker. Always
+#  signed 16-bit little-endian, which the mixer works in.
+class AudioFormat():
+
+    SAMPLE_FORMAT = "S16_LE"
+    SAMPLE_WIDTH = 2
+
+    def __init__(self,channels=CONVERSION_CHANNELS,sample_rate=CONVERSION_SAMPLE_RATE):
+        self.channels = channels
+        self.sample_rate = sample_rate
+
+    def __eq__(self,other):
+        return isinstance(other, AudioFormat) and self.params() == other.params()
+
+    def __str__(self):
+        return "%d Hz, %d channel(s), %s" % (self.sample_rate, self.channels, 
+            self.SAMPLE_FORMAT)
+
+    # part of every cache key, so a change of format maps to new entries
+    def params(self):
+        return "%dch-%dhz-%s" % (self.channels, self.sample_rate, 
+            self.SAMPLE_FORMAT.lower())
+
+    def matches(self,channels,sample_width,sample_rate):
+        return (channels, sample_width, sample_rate) == (self.channels, 
+            self.SAMPLE_WIDTH, self.sample_rate)
+
+    def to_dict(self):
+        return {"channels": self.channels, "sample_rate": self.sample_rate,
+            "format": self.SAMPLE_FORMAT}
+
+# pick from what a device reports: a single value, a list of values or a 
+#  (min, max) range
+def choose_native(supported,preferred):
+    if isinstance(supported, int):
+        return supported
+    if isinstance(supported, tuple) and len(supported) == 2:
+        for value in preferred:
+            if supported[0] <= value <= supported[1]:
+                return value
+        return supported[1]
+    for value in preferred:
+        if value in supported:
+            return value
+    return supported[0]
+
+# the device cached audio is converted for: the first zone's, or the 
+#  [general] one when no zones are configured. The bridge and the --rerender 
+#  and --presynthesize commands must agree on it.
+def output_device():
+    zone_sections = [section for section in config.sections() 
+        if section.startswith("zone:")]
+    return config.get(zone_sections[0] if zone_sections else 'general', 
+        'pcm_device', fallback='default')
+
+# Determine the output format: [output] channels / sample_rate if set, else 
+#  what the playback device reports. The result is remembered in the cache
+#  so a device that is busy (or a sink that is not a device) keeps the last
+#  negotiated format rather than falling back to the defaults.
+def negotiate_output_format(device):
+
+    remembered_file = Path(CACHE_PATH) / "output_format.json"
+    remembered = None
+    try:
+        data = json.loads(remembered_file.read_text())
+        remembered = AudioFormat(data["channels"], data["sample_rate"])
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        pass
+
+    channels = config.getint('output', 'channels', fallback=0)
+    sample_rate = config.getint('output', 'sample_rate', fallback=0)
+    sink_type = config.get('output', 'sink', fallback='alsa')
+
+    if not (channels and sample_rate) and sink_type == 'alsa':
+        try:
+            pcm = alsa.PCM(type=alsa.PCM_PLAYBACK, device=device)
+            try:
+                if AudioFormat.SAMPLE_FORMAT not in pcm.getformats():
+                    logger.warning("'%s' does not list %s; relying on alsa to convert" 
+                        % (device, AudioFormat.SAMPLE_FORMAT))
+                channels = channels or choose_native(pcm.getchannels(), NATIVE_CHANNELS)
+                sample_rate = sample_rate or choose_native(pcm.getrates(), NATIVE_SAMPLE_RATES)
+            finally:
+                pcm.close()
+        except Exception as e:
+            logger.warning("unable to query '%s' (%s)" % (device, e.__repr__()))
+
+    if channels and sample_rate:
+        audio_format = AudioFormat(channels, sample_rate)
+    else:
+        audio_format = remembered or AudioFormat()
+
+    if remembered and remembered != audio_format:
+        logger.warning("output format changed from %s to %s; run --rerender to "
+            "convert cached speech" % (remembered, audio_format))
+    if remembered != audio_format:
+        remembered_file.parent.mkdir(parents=True, exist_ok=True)
+        remembered_file.write_text(json.dumps(audio_format.to_dict()))
+    logger.info("output format: %s" % audio_format)
+    return audio_format
+
+# format files are decoded to before they are converted to the target
+DECODE_CHANNELS = 2
+DECODE_SAMPLE_RATE = 44100
+
+# requires packages: miniaudio, array
+def convert_audio_miniaudio(in_file, out_file, channels=CONVERSION_CHANNELS, 
+        sample_rate=CONVERSION_SAMPLE_RATE):
+
+    src = miniaudio.decode_file(in_file, miniaudio.SampleFormat.SIGNED16,
+        DECODE_CHANNELS, DECODE_SAMPLE_RATE) # , dither=miniaudio.DitherMode.TRIANGLE
+    
+    # DecodedSoundFile - Contains various properties and also the PCM frames of 
+    #  a fully decoded audio file.
+    tgt = miniaudio.DecodedSoundFile("result", channels, sample_rate, 
+        miniaudio.SampleFormat.SIGNED16, array.array('b'))
+    
+    converted_frames = miniaudio.convert_frames(
+        src.sample_format, src.nchannels, src.sample_rate, src.samples.tobytes(),
+        tgt.sample_format, tgt.nchannels, tgt.sample_rate)
+    
+    tgt.num_frames = int(len(converted_frames) / tgt.nchannels / tgt.sample_width)
+    tgt.samples.frombytes(converted_frames)
+
+    miniaudio.wav_write_file(out_file, tgt)
+    
+    logger.debug("wrote converted file to '%s'" % out_file)
+    
+    return False
+
+# Decode, resample and write in fixed size chunks so memory use does not 
+#  grow with the length of the recording. Mirrors the two stages of the 
+#  buffered converter so the output is byte-identical: the file is decoded 
+#  to DECODE_CHANNELS/DECODE_SAMPLE_RATE as decode_file does, then those
+#  chunks are fed as a wav stream through a second decoder that converts to
+#  the target format, keeping its resampler state from chunk to chunk just 
+#  as a single convert_frames call over the whole file does. Reports the 
+#  peak bytes held in buffers over the conversion.
+CONVERSION_CHUNK_FRAMES = 8192
+
+# raw 16-bit chunks presented to miniaudio.stream_any as a wav of unknown 
+#  length; tracks the bytes waiting to be read
+class PcmChunkSource():
+
+    ffi_handle = None
+    error_in_readcallback = None
+
+    def __init__(self,chunks,channels,sample_rate):
+        self.chunks = chunks
+        # sizes large enough for any recording; decoding stops where the
+        #  chunks do
+        self.pending = bytearray(b"RIFF" + (0x7FFFFFFC).to_bytes(4, "little") 
+            + b"WAVEfmt " + (16).to_bytes(4, "little") + (1).to_bytes(2, "little")
+            + channels.to_bytes(2, "little") + sample_rate.to_bytes(4, "little")
+            + (sample_rate * channels * 2).to_bytes(4, "little")
+            + (channels * 2).to_bytes(2, "little") + (16).to_bytes(2, "little")
+            + b"data" + (0x7FFFFFD8).to_bytes(4, "little"))
+        self.peak_bytes = 0
+
+    def read(self,num_bytes):
+        while len(self.pending) < num_bytes:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += memoryview(chunk).cast('B')
+            self.peak_bytes = max(self.peak_bytes, len(self.pending) + len(chunk) * chunk.itemsize)
+        data = bytes(self.pending[:num_bytes])
+        del self.pending[:num_bytes]
+        return data
+
+    def seek(self,offset,origin):
+        return False
+
+    def close(self):
+        pass
+
+def convert_audio_streaming(in_file, out_file, channels=CONVERSION_CHANNELS, 
+        sample_rate=CONVERSION_SAMPLE_RATE):
+
+    frames = 0
+    peak_chunk = 0
+    # each decoder keeps a buffer of at least 16384 frames
+    decoder_bytes = max(CONVERSION_CHUNK_FRAMES, 16384) * 2 * (DECODE_CHANNELS + channels)
+
+    decoded = miniaudio.stream_file(in_file, miniaudio.SampleFormat.SIGNED16,
+        DECODE_CHANNELS, DECODE_SAMPLE_RATE, CONVERSION_CHUNK_FRAMES)
+    source = PcmChunkSource(decoded, DECODE_CHANNELS, DECODE_SAMPLE_RATE)
+    with wave.open(out_file, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        for chunk in miniaudio.stream_any(source, miniaudio.FileFormat.WAV, 
+                miniaudio.SampleFormat.SIGNED16, channels, sample_rate, 
+                CONVERSION_CHUNK_FRAMES):
+            wav.writeframesraw(chunk)
+            frames += len(chunk) // channels
+            peak_chunk = max(peak_chunk, len(chunk) * chunk.itemsize)
+    if source.error_in_readcallback:
+        raise source.error_in_readcallback
+
+    logger.debug("wrote converted file to '%s' (%d frames, peak memory %d bytes)" 
+        % (out_file, frames, decoder_bytes + source.peak_bytes + peak_chunk))
+
+    return False
+
+# convert with both converters and compare the results; reports the peak 
+#  python heap use of each (see the --verify-conversion option)
+def verify_conversion(in_file, channels=CONVERSION_CHANNELS, 
+        sample_rate=CONVERSION_SAMPLE_RATE):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, converter in (("buffered", convert_audio_miniaudio),
+                ("streaming", convert_audio_streaming)):
+            out_file = "%s/%s.wav" % (tmp, name)
+            tracemalloc.start()
+            converter(str(in_file), out_file, channels, sample_rate)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(out_file, 'rb') as f:
+                results[name] = (hashlib.sha1(f.read()).hexdigest(), peak)
+    identical = results["buffered"][0] == results["streaming"][0]
+    logger.info("%s -> %dch/%dHz: %s; peak memory buffered %d bytes, streaming %d bytes" 
+        % (in_file, channels, sample_rate, "identical" if identical else "DIFFERENT", 
+        results["buffered"][1], 
+        results["streaming"][1]))
+    return identical
+
+# use ffmpeg to convert files -- significantly slower process
+#  only to be used if miniaudio is unable
+def convert_audio_ffmpeg(filename_input, filename_output, channels=CONVERSION_CHANNELS, 
+        sample_rate=CONVERSION_SAMPLE_RATE):
+    
+    filename_input = str(filename_input) # "'%s'" % filename_input
+    filename_output = str(filename_output) # "'%s'" % filename_output
+    
+    # ffmpeg -i input.mp3 output.ogg
+
+    # -v fatal - Only show fatal errors. These are errors after which the 
+    #            process absolutely cannot continue. 
+    ffmpeg = subprocess.run(["/usr/bin/ffmpeg", "-v", "fatal", "-hide_banner", "-nostdin", "-y",
+                           "-i", filename_input, "-acodec", "pcm_s16le",
+                           "-ac", str(channels), "-ar", str(sample_rate), filename_output],
+                           capture_output=True, timeout=15)
+
+    logger.debug("called: %s" % ' '.join(ffmpeg.args))
+
+    if ffmpeg.returncode:
+        logger.debug("ffmpeg return code: % s" % ffmpeg.returncode)
+        logger.debug("ffmpeg stdout: % s" % ffmpeg.stdout)
+        logger.debug("ffmpeg stderr: % s" % ffmpeg.stderr)
+    
+    return ffmpeg.returncode
+
+# returns a truthy value on failure
+def convert_audio_file(filename_src, filename_dst, channels=CONVERSION_CHANNELS, 
+        sample_rate=CONVERSION_SAMPLE_RATE):
+    logger.debug("converting '%s' to '%s'." % (filename_src,filename_dst))
+    try:
+        with metrics.timer("convert_miniaudio"):
+            if conversionMode == 'buffered':
+                return convert_audio_miniaudio(str(filename_src), str(filename_dst),
+                    channels, sample_rate)
+            return convert_audio_streaming(str(filename_src), str(filename_dst),
+                channels, sample_rate)
+    except Exception as e:
+        logger.info("miniaudio unable to convert '%s' (%s); trying ffmpeg" 
+            % (filename_src, e.__repr__()))
+        with metrics.timer("convert_ffmpeg"):
+            return convert_audio_ffmpeg(filename_src, filename_dst, channels, sample_rate)
+
+# convert into a hidden temporary file beside the target and rename it into
+#  place so a reader never sees a partially written file. Runs in the 
+#  SoundConverter process pool, so it must stay a module level function.
+def convert_audio_atomic(filename_src, filename_dst, channels=CONVERSION_CHANNELS, 
+        sample_rate=CONVERSION_SAMPLE_RATE):
+    filename_dst = Path(filename_dst)
+    filename_tmp = filename_dst.with_name(".%s.%d-%d%s" % (filename_dst.stem, 
+        os.getpid(), threading.get_ident(), filename_dst.suffix))
+    try:
+        if convert_audio_file(filename_src, filename_tmp, channels, sample_rate):
+            return True
+        os.replace(filename_tmp, filename_dst)
+    finally:
+        if filename_tmp.exists():
+            filename_tmp.unlink()
+    return False
+
+# In-memory index of the sound library so a play request does not have to
+#  walk SOUNDS_PATH. Maps lowercased file stem -> candidate files. Kept
+#  current with inotify when available, else with a periodic directory
+#  mtime diff.
+class SoundLibraryIndex():
+
+    # longest a lookup waits for the initial scan before answering from 
+    #  whatever has been indexed
+    BUILD_WAIT = 10.0
+
+    def __init__(self,root,poll_interval=30,exclude=()):
+
+        self.root = Path(root)
+        self.exclude = set(Path(e) for e in exclude)
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.stems = {}
+        self.dir_mtimes = {}
+        self.hits = 0
+        self.misses = 0
+        self.watcher = None
+        self.watcher_mode = None
+        self.built = threading.Event()
+
+    # os.walk that does not descend into excluded directories
+    def walk(self,top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames 
+                if Path(dirpath) / d not in self.exclude]
+            yield dirpath, dirnames, filenames
+
+    def rebuild(self):
+        stems = {}
+        dir_mtimes = {}
+        for dirpath, dirnames, filenames in self.walk(self.root):
+            try:
+                dir_mtimes[dirpath] = os.stat(dirpath).st_mtime
+            except FileNotFoundError:
+                continue
+            for filename in filenames:
+                localfile = Path(dirpath) / filename
+                stems.setdefault(localfile.stem.lower(), []).append(localfile)
+        with self.lock:
+            self.stems = stems
+            self.dir_mtimes = dir_mtimes
+        self.built.set()
+        logger.info("sound index built: %s files, %s names under %s" % (
+            sum(len(c) for c in stems.values()), len(stems), self.root))
+
+    def add(self,filepath):
+        filepath = Path(filepath)
+        with self.lock:
+            candidates = self.stems.setdefault(filepath.stem.lower(), [])
+            if filepath not in candidates:
+                candidates.append(filepath)
+
+    def remove(self,filepath):
+        filepath = Path(filepath)
+        key = filepath.stem.lower()
+        with self.lock:
+            candidates = self.stems.get(key, [])
+            if filepath in candidates:
+                candidates.remove(filepath)
+            if not candidates:
+                self.stems.pop(key, None)
+
+    def remove_tree(self,dirpath):
+        dirpath = Path(dirpath)
+        with self.lock:
+            for key in list(self.stems):
+                candidates = [c for c in self.stems[key] 
+                    if dirpath not in c.parents]
+                if candidates:
+                    self.stems[key] = candidates
+                else:
+                    del self.stems[key]
+
+    # prefer a file in one of SUPPORTED_FORMATS, otherwise return the last
+    #  candidate seen (same preference the rglob scan used to have)
+    def lookup(self,name):
+        # a request arriving during startup waits for the initial scan
+        if not self.built.wait(self.BUILD_WAIT):
+            logger.warning("sound index: initial scan not finished; looking up '%s' anyway" 
+                % name)
+        with self.lock:
+            candidates = self.stems.get(name.lower())
+            if not candidates:
+                self.misses += 1
+                return None
+            self.hits += 1
+            for candidate in candidates:
+                if candidate.suffix[1:] in SUPPORTED_FORMATS:
+                    return candidate
+            return candidates[-1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "names": len(self.stems),
+                "files": sum(len(c) for c in self.stems.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "watcher": self.watcher_mode,
+            }
+
+    # the initial scan runs on the watcher thread so startup need not wait
+    #  for it; with inotify the watches are set before scanning so nothing
+    #  created in between is missed
+    def start(self):
+        if inotify_simple:
+            self.watcher_mode = "inotify"
+            target = self.watch_inotify
+        else:
+            self.watcher_mode = "poll"
+            target = self.watch_poll
+        self.watcher = threading.Thread(target=target, 
+            name="sound-index", daemon=True)
+        self.watcher.start()
+
+    def alive(self):
+        return bool(self.watcher and self.watcher.is_alive())
+
+    # -- inotify
+
+    # inotify can fail outright (e.g. the per-user instance or watch limits),
+    #  in which case the index falls back to polling
+    def watch_inotify(self):
+        inotify = None
+        try:
+            inotify = inotify_simple.INotify()
+            self.follow_inotify(inotify)
+        except Exception as e:
+            logger.error("sound index: inotify failed (%s); polling every %ss instead" 
+                % (e.__repr__(), self.poll_interval))
+        finally:
+            if inotify:
+                inotify.close()
+        self.watcher_mode = "poll"
+        self.watch_poll()
+
+    def follow_inotify(self,inotify):
+        flags = inotify_simple.flags
+        mask = (flags.CREATE | flags.DELETE | flags.MOVED_FROM | 
+            flags.MOVED_TO | flags.CLOSE_WRITE | flags.DELETE_SELF)
+        watches = {}
+
+        def add_watch(dirpath):
+            for sub, dirnames, filenames in self.walk(dirpath):
+                try:
+                    watches[inotify.add_watch(sub, mask)] = Path(sub)
+                except OSError as e:
+                    # out of watches: changes would go unseen, so poll instead
+                    if e.errno == errno.ENOSPC:
+                        raise
+                    logger.error("sound index: unable to watch '%s': %s" % (sub,e))
+
+        add_watch(self.root)
+        self.rebuild()
+        while True:
+            for event in inotify.read():
+                # the kernel queue overflowed and events were lost
+                if event.mask & flags.Q_OVERFLOW:
+                    logger.warning("sound index: inotify queue overflowed; rescanning")
+                    self.rebuild()
+                    continue
+                dirpath = watches.get(event.wd)
+                if dirpath is None:
+                    continue
+                if event.mask & flags.DELETE_SELF:
+                    watches.pop(event.wd, None)
+                    continue
+                if not event.name:
+                    continue
+                filepath = dirpath / event.name
+                if event.mask & flags.ISDIR:
+                    if filepath in self.exclude:
+                        continue
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        add_watch(filepath)
+                        for sub, dirnames, filenames in self.walk(filepath):
+                            for filename in filenames:
+                                self.add(Path(sub) / filename)
+                    else:
+                        self.remove_tree(filepath)
+                elif event.mask & (flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE):
+                    self.add(filepath)
+                elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                    self.remove(filepath)
+
+    # -- periodic mtime diff fallback
+    # a file created, removed or renamed updates the mtime of its parent 
+    #  directory, so only directories need to be stat'd on each pass
+
+    def watch_poll(self):
+        try:
+            self.rebuild()
+        except Exception as e:
+            logger.error("sound index scan failed: %s" % e.__repr__())
+        self.built.set()
+        while True:
+            sleep(self.poll_interval)
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error("sound index poll failed: %s" % e.__repr__())
+
+    def poll_once(self):
+        seen = {}
+        changed = []
+        for dirpath, dirnames, filenames in self.walk(self.root):
+            try:
+                mtime = os.stat(dirpath).st_mtime
+            except FileNotFoundError:
+                continue
+            seen[dirpath] = mtime
+            if self.dir_mtimes.get(dirpath) != mtime:
+                changed.append((Path(dirpath), filenames))
+
+        for dirpath in set(self.dir_mtimes) - set(seen):
+            self.remove_tree(dirpath)
+
+        for dirpath, filenames in changed:
+            current = set(dirpath / f for f in filenames)
+            with self.lock:
+                indexed = set(c for candidates in self.stems.values() 
+                    for c in candidates if c.parent == dirpath)
+            for filepath in indexed - current:
+                self.remove(filepath)
+            for filepath in current - indexed:
+                self.add(filepath)
+
+        self.dir_mtimes = seen
+        if changed:
+            logger.debug("sound index: rescanned %d directories" % len(changed))
+
+# peak and rms of a 16-bit wav as fractions of full scale; None for other
+#  sample widths. Measured once when a file enters a cache and stored in 
+#  that cache's index so playback can normalize without rescanning samples.
+def measure_loudness(filename):
+    with wave.open(str(filename), 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            return None
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    if not samples.size:
+        return {"peak": 0.0, "rms": 0.0}
+    scaled = samples.astype(np.float32) / 32768.0
+    return {
+        "peak": float(np.max(np.abs(scaled))),
+        "rms": float(np.sqrt(np.mean(scaled * scaled))),
+    }
+
+# scale signed 16-bit pcm by gain, clipping at full scale
+def apply_gain(pcm, gain):
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+    samples *= gain
+    np.clip(samples, -32768, 32767, out=samples)
+    return samples.astype(np.int16).tobytes()
+
+# Converts library files that are not in a SUPPORTED_FORMAT, or are wavs in
+#  a layout other than the output format, into the sounds cache ahead of 
+#  time, in parallel across cores, so playback only ever reads converted 
+#  audio from the cache. Files not yet converted when they are requested 
+#  (e.g. added after startup) are converted on demand.
+#
+# The cache is content addressed: an output is named by a hash of the source
+#  file contents plus the conversion parameters, so sources that share a stem
+#  no longer collide, identical sources are converted and stored once, and an
+#  edited source (or a change of parameters) maps to a new entry. A manifest
+#  remembers each source's size, mtime and key so unchanged sources are not
+#  re-hashed. Outputs no source refers to any more are garbage collected.
+class SoundConverter():
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self,sounds_path,cache_path,workers=None,audio_format=None):
+
+        self.sounds_path = Path(sounds_path)
+        self.audio_format = audio_format or AudioFormat()
+        self.cache_path = Path(cache_path)
+        self.manifest_path = self.cache_path / self.MANIFEST
+        self.workers = workers or os.cpu_count()
+        self.lock = threading.Lock()
+        self.converted = 0
+        self.skipped = 0
+        self.deduped = 0
+        self.failed = 0
+        self.collected = 0
+
+        # source path -> {"size", "mtime", "key"}
+        self.sources = {}
+        # output file name -> {"last_used", "hits"}
+        self.outputs = {}
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+                self.sources = manifest.get("sources", {})
+                self.outputs = manifest.get("outputs", {})
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning("sound cache manifest unreadable (%s); rebuilding" % e)
+
+    def conversion_params(self):
+        return "%s-%s" % (self.audio_format.params(), PREFERRED_FORMAT)
+
+    # whether source has to go through the cache to play in the output format
+    def needs_conversion(self,source):
+        source = Path(source)
+        if source.suffix[1:] not in SUPPORTED_FORMATS:
+            return True
+        try:
+            with wave.open(str(source), 'rb') as wav:
+                return not self.audio_format.matches(wav.getnchannels(),
+                    wav.getsampwidth(), wav.getframerate())
+        except (wave.Error, EOFError):
+            # e.g. float or compressed wavs the wave module cannot read
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def hash_file(source):
+        digest = hashlib.sha1()
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def target_for(self,key):
+        return self.cache_path / ("%s.%s" % (key, PREFERRED_FORMAT))
+
+    # cache key of source; only hashed when its size or mtime has changed
+    def key_for(self,source):
+        source = str(source)
+        st = os.stat(source)
+        params = self.conversion_params()
+        with self.lock:
+            entry = self.sources.get(source)
+        if (entry and entry["size"] == st.st_size and 
+                entry["mtime"] == st.st_mtime and entry.get("params") == params):
+            return entry["key"]
+        material = "%s:%s" % (self.hash_file(source), params)
+        key = hashlib.sha1(material.encode('utf-8')).hexdigest()
+        with self.lock:
+            self.sources[source] = {"size": st.st_size, "mtime": st.st_mtime,
+                "params": params, "key": key}
+        return key
+
+    def write_manifest(self):
+        with self.lock:
+            data = json.dumps({"sources": self.sources, "outputs": self.outputs})
+        tmp_path = self.manifest_path.with_name(".%s" % self.MANIFEST)
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.manifest_path)
+
+    def candidates(self):
+        for dirpath, dirnames, filenames in os.walk(self.sounds_path):
+            dirnames[:] = [d for d in dirnames 
+                if Path(dirpath) / d != Path(CACHE_PATH)]
+            for filename in filenames:
+                source = Path(dirpath) / filename
+                if self.needs_conversion(source):
+                    yield source
+
+    # path of the cached conversion of source, converting it first if needed
+    def cached(self,source):
+        target = self.target_for(self.key_for(source))
+        if not target.exists():
+            logger.debug("located a file as conversion candidate: %s" % source)
+            if convert_audio_atomic(source, target, self.audio_format.channels,
+                    self.audio_format.sample_rate):
+                with self.lock:
+                    self.failed += 1
+                return None
+            with self.lock:
+                self.converted += 1
+            self.record_loudness(target)
+            self.write_manifest()
+        self.touch(target)
+        return target
+
+    def record_loudness(self,target):
+        try:
+            loudness = measure_loudness(target)
+        except Exception as e:
+            logger.warning("unable to measure '%s': %s" % (target, e.__repr__()))
+            return
+        if loudness:
+            with self.lock:
+                self.outputs.setdefault(target.name, {"hits": 0}).update(loudness)
+
+    def loudness(self,target):
+        with self.lock:
+            output = self.outputs.get(Path(target).name)
+            if output and "rms" in output:
+                return output
+        return None
+
+    def touch(self,target):
+        with self.lock:
+            output = self.outputs.setdefault(target.name, {"hits": 0})
+            output["last_used"] = time()
+            output["hits"] += 1
+
+    def evict(self,target):
+        target.unlink(missing_ok=True)
+        with self.lock:
+            self.outputs.pop(target.name, None)
+
+    def start(self):
+        threading.Thread(target=self.convert_all, 
+            name="sound-converter", daemon=True).start()
+
+    def convert_all(self):
+        started = monotonic()
+        pending = {}
+        # forkserver: forking a process that already runs threads is unsafe
+        context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            for source in self.candidates():
+                try:
+                    target = self.target_for(self.key_for(source))
+                except OSError as e:
+                    logger.error("unable to read '%s': %s" % (source, e))
+                    continue
+                if target.exists():
+                    self.skipped += 1
+                    continue
+                if target in pending.values():
+                    self.deduped += 1
+                    continue
+                pending[pool.submit(convert_audio_atomic, source, target,
+                    self.audio_format.channels, self.audio_format.sample_rate)] = target
+            for future in as_completed(pending):
+                try:
+                    failed = future.result()
+                except Exception as e:
+                    logger.error("error converting to '%s': %s" 
+                        % (pending[future], e.__repr__()))
+                    failed = True
+                with self.lock:
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.converted += 1
+                if not failed:
+                    self.record_loudness(pending[future])
+        self.collect_garbage()
+        logger.info("sound conversion: %d converted, %d up to date, %d duplicates, "
+            "%d failed, %d orphans removed in %.1fs" % (self.converted, 
+            self.skipped, self.deduped, self.failed, self.collected, 
+            monotonic() - started))
+
+    # forget sources that no longer exist and remove cached outputs that no
+    #  remaining source maps to
+    def collect_garbage(self):
+        with self.lock:
+            for source in list(self.sources):
+                if not Path(source).exists():
+                    del self.sources[source]
+            live = set(self.target_for(entry["key"]).name 
+                for entry in self.sources.values())
+            for name in list(self.outputs):
+                if name not in live:
+                    del self.outputs[name]
+        for cached in self.cache_path.iterdir():
+            if cached.name == self.MANIFEST or cached.name in live:
+                continue
+            # leave conversions still being written by another thread alone
+            if cached.name.startswith("."):
+                continue
+            logger.debug("sound cache: removing orphan '%s'" % cached.name)
+            cached.unlink()
+            self.collected += 1
+        self.write_manifest()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sources": len(self.sources),
+                "converted": self.converted,
+                "up_to_date": self.skipped,
+                "duplicates": self.deduped,
+                "failed": self.failed,
+                "orphans_removed": self.collected,
+                "format": self.audio_format.params(),
+            }
+
+# Keeps the TTS and converted sound caches within a shared disk budget.
+#  Runs periodically: persists access times, optionally drops the ogg copy 
+#  of TTS phrases, then evicts the entries with the lowest score until the
+#  caches fit. The score is the last use time plus a bonus that grows with 
+#  the number of hits, so a phrase played often outlives one played once a
+#  little more recently. Evicted sounds are reconverted from their source
+#  if requested again; evicted phrases are synthesized again.
+class CacheManager():
+
+    # seconds of recency credited per doubling of the hit count
+    FREQUENCY_WEIGHT = 86400
+
+    def __init__(self,database,converter,budget_bytes,interval=600,tts_keep="both"):
+
+        self.database = database
+        self.converter = converter
+        self.budget_bytes = budget_bytes
+        self.interval = interval
+        self.tts_keep = tts_keep
+        self.evicted = 0
+        self.reclaimed_bytes = 0
+        self.last_usage = 0
+
+    def start(self):
+        threading.Thread(target=self.run, name="cache-manager", daemon=True).start()
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.maintain()
+            except Exception as e:
+                logger.error("cache maintenance failed: %s" % e.__repr__())
+
+    def score(self,last_used,hits):
+        return (last_used or 0) + self.FREQUENCY_WEIGHT * math.log2(1 + (hits or 0))
+
+    @staticmethod
+    def file_size(filepath):
+        try:
+            return os.stat(filepath).st_size
+        except FileNotFoundError:
+            return 0
+
+    def maintain(self):
+        self.database.flush_access()
+        self.converter.write_manifest()
+
+        reclaimed = 0
+        if self.tts_keep == "wav":
+            reclaimed += self.drop_ogg()
+
+        # size is what evicting a candidate eventually frees; files is what
+        #  leaves the disk straight away (packed audio goes at compaction)
+        candidates = []
+        for key, tts in list(self.database.entries.items()):
+            size = self.database.size_of(tts)
+            candidates.append((self.score(tts.get("last_used"), tts.get("hits")),
+                size, self.database.size_of(tts, packed=False), "tts", key, 
+                tts.get("last_used"), tts.get("hits")))
+        for name, output in list(self.converter.outputs.items()):
+            size = self.file_size(self.converter.cache_path / name)
+            if size:
+                candidates.append((self.score(output.get("last_used"), output.get("hits")),
+                    size, size, "sound", name, output.get("last_used"), output.get("hits")))
+
+        # what is on disk: files, plus whole packs including dead segments
+        usage = sum(c[2] for c in candidates)
+        if self.database.pack:
+            usage += self.database.pack.disk_bytes()
+        self.last_usage = usage
+        over_budget = self.budget_bytes and usage > self.budget_bytes
+        if over_budget:
+            candidates.sort()
+            for score, size, files, kind, key, last_used, hits in candidates:
+                if usage <= self.budget_bytes:
+                    break
+                self.evict(kind, key)
+                logger.info("cache: evicted %s '%s' (%d bytes, %s hits, last used %s)" 
+                    % (kind, key, size, hits or 0, 
+                        datetime.fromtimestamp(last_used).isoformat() if last_used else "never"))
+                usage -= size
+                reclaimed += files
+                self.evicted += 1
+            self.database.compact()
+
+        if self.database.pack:
+            # over budget, any pack with dead segments is rewritten so the 
+            #  space evicted above actually leaves the disk
+            reclaimed += self.database.pack.compact(1.0 if over_budget else 0.5)
+            usage = self.disk_usage()
+
+        self.reclaimed_bytes += reclaimed
+        self.last_usage = usage
+        if reclaimed:
+            logger.info("cache: reclaimed %d bytes; %d of %d bytes used" 
+                % (reclaimed, usage, self.budget_bytes))
+
+    # bytes both caches take on disk, dead pack segments included
+    def disk_usage(self):
+        usage = sum(self.database.size_of(tts, packed=False) 
+            for tts in list(self.database.entries.values()))
+        usage += sum(self.file_size(self.converter.cache_path / name) 
+            for name in list(self.converter.outputs))
+        if self.database.pack:
+            usage += self.database.pack.disk_bytes()
+        return usage
+
+    def evict(self,kind,key):
+        if kind == "tts":
+            self.database.delete_tts(key)
+        else:
+            self.converter.evict(self.converter.cache_path / key)
+
+    # only the wav is played; the ogg is kept by default as the original
+    def drop_ogg(self):
+        reclaimed = 0
+        for key, tts in list(self.database.entries.items()):
+            if "ogg" in tts["extensions"] and "wav" in tts["extensions"]:
+                ogg = Path("%s/%s.ogg" % (self.database.tts_cache_path, tts["filename"]))
+                reclaimed += self.file_size(ogg)
+                ogg.unlink(missing_ok=True)
+                self.database.drop_extension(key, "ogg")
+        return reclaimed
+
+    def stats(self):
+        return {
+            "usage_bytes": self.last_usage,
+            "budget_bytes": self.budget_bytes,
+            "evicted": self.evicted,
+            "reclaimed_bytes": self.reclaimed_bytes,
+        }
+
+# Decoded WaveObjects kept in RAM so hot sounds are not re-read from disk on
+#  every play. Bounded by a byte budget with least recently used eviction;
+#  sounds whose library name is pinned are never evicted. An entry is 
+#  reloaded if its file has been modified since it was cached.
+class WaveObjectCache():
+
+    def __init__(self,budget_bytes,pinned=()):
+
+        self.budget_bytes = budget_bytes
+        self.pinned = set(name.lower() for name in pinned)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # name is the sound's library name, which pinned_sounds refers to; a 
+    #  converted sound lives in the cache under a hash instead
+    def get(self,filepath,name=None):
+        key = str(filepath)
+        mtime = os.stat(key).st_mtime
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[2] == mtime:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        wave_obj = simpleaudio.WaveObject.from_wave_file(key)
+        size = len(wave_obj.audio_data)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+            if size <= self.budget_bytes:
+                self.entries[key] = (wave_obj, size, mtime, 
+                    self.is_pinned(name or Path(key).stem))
+                self.size += size
+                self.evict()
+        return wave_obj
+
+    def is_pinned(self,name):
+        return Path(name).stem.lower() in self.pinned
+
+    # caller holds self.lock
+    def evict(self):
+        if self.size <= self.budget_bytes:
+            return
+        for key in list(self.entries):
+            if self.size <= self.budget_bytes:
+                break
+            if self.entries[key][3]:
+                continue
+            wave_obj, size, mtime, pinned = self.entries.pop(key)
+            self.size -= size
+            self.evictions += 1
+            logger.debug("pcm cache: evicted '%s' (%d bytes)" % (key, size))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "budget_bytes": self.budget_bytes,
+                "pinned": sum(1 for entry in self.entries.values() if entry[3]),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+# -- Mixing engine
+# One long-lived output stream fed by a mixer thread. Each sound is a Voice
+#  with its own gain; voices are summed a period at a time into a small ring
+#  buffer of rendered periods that a second thread writes to the sink. While
+#  a voice of a triggering class plays, voices of a ducked class are faded
+#  down to the rule's gain. Voices implement the parts of simpleaudio's 
+#  PlayObject the scheduler uses (wait_done, is_playing, stop).
+
+def sample_format(sample_width):
+    return {
+        1: miniaudio.SampleFormat.UNSIGNED8,
+        2: miniaudio.SampleFormat.SIGNED16,
+        3: miniaudio.SampleFormat.SIGNED24,
+        4: miniaudio.SampleFormat.SIGNED32,
+    }[sample_width]
+
+# stateful linear resampler for audio that arrives in chunks (streamed
+#  speech); carries the last frame and fractional position across calls so
+#  chunk boundaries do not click
+class LinearResampler():
+
+    def __init__(self,src_rate,dst_rate):
+        self.step = src_rate / dst_rate
+        self.pos = 0.0
+        self.prev = None
+
+    # frames: float32 array shaped (frames, channels)
+    def process(self,frames):
+        if self.prev is not None:
+            frames = np.concatenate((self.prev, frames))
+        count = len(frames)
+        if count < 2:
+            self.prev = frames
+            return frames[:0]
+        positions = np.arange(self.pos, count - 1, self.step)
+        index = positions.astype(np.int64)
+        frac = (positions - index)[:, None].astype(np.float32)
+        out = frames[index] * (1 - frac) + frames[index + 1] * frac
+        last = positions[-1] if positions.size else self.pos - self.step
+        self.pos = last + self.step - (count - 1)
+        self.prev = frames[-1:]
+        return out
+
+class Voice():
+
+    def __init__(self,samples,gain=1.0,duck_class="foreground",streaming=False):
+        self.samples = samples
+        self.position = 0
+        self.gain = gain
+        self.duck_class = duck_class
+        self.streaming = streaming
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.finished = False
+        self.stopped = False
+        self.started = False
+        self.queued_at = monotonic()
+
+    def wait_done(self):
+        self.done.wait()
+
+    def is_playing(self):
+        return not self.done.is_set()
+
+    def stop(self):
+        self.stopped = True
+        self.done.set()
+
+    # append samples to a streaming voice
+    def feed(self,samples):
+        with self.lock:
+            self.samples = np.concatenate((self.samples[self.position:], samples))
+            self.position = 0
+
+    # no more samples will be fed; the voice ends once it has played out
+    def close(self):
+        self.streaming = False
+
+    # up to count samples; a drained streaming voice reads as silence
+    def read(self,count):
+        with self.lock:
+            chunk = self.samples[self.position:self.position + count]
+            self.position += len(chunk)
+            if self.position >= len(self.samples) and not self.streaming:
+                self.finished = True
+        return chunk
+
+class AlsaSink():
+
+    def __init__(self,device,sample_rate,channels,period_frames):
+        self.pcm = alsa.PCM(type=alsa.PCM_PLAYBACK, device=device,
+            rate=sample_rate, channels=channels, format=alsa.PCM_FORMAT_S16_LE,
+            periodsize=period_frames)
+
+    def write(self,pcm):
+        self.pcm.write(pcm)
+
+    def close(self):
+        self.pcm.close()
+
+# discards audio, paced in real time like a device would be
+class NullSink():
+
+    def __init__(self,sample_rate,channels,period_frames):
+        self.period = period_frames / sample_rate
+        self.deadline = None
+
+    def write(self,pcm):
+        now = monotonic()
+        if self.deadline is None or self.deadline < now - self.period:
+            self.deadline = now
+        self.deadline += self.period
+        delay = self.deadline - now
+        if delay > 0:
+            sleep(delay)
+
+    def close(self):
+        pass
+
+# writes everything played to a wav file, for testing without hardware
+class FileSink(NullSink):
+
+    def __init__(self,filename,sample_rate,channels,period_frames):
+        super().__init__(sample_rate,channels,period_frames)
+        self.wav = wave.open(str(filename), 'wb')
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sample_rate)
+
+    def write(self,pcm):
+        self.wav.writeframes(pcm)
+        super().write(pcm)
+
+    def close(self):
+        self.wav.close()
+
+class AudioMixer():
+
+    # a ducked class fades towards its target gain by this much per period
+    DUCK_STEP = 0.1
+
+    def __init__(self,sink,sample_rate,channels,period_frames=1024,
+            buffer_periods=4,ducking=None):
+
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.period_frames = period_frames
+        self.period_samples = period_frames * channels
+        self.silence = bytes(self.period_samples * 2)
+        # ducked class -> (classes that trigger ducking, gain while ducked)
+        self.ducking = ducking or {}
+        self.duck_levels = dict((duck_class, 1.0) for duck_class in self.ducking)
+
+        self.voices = []
+        self.lock = threading.Lock()
+        self.ring = deque()
+        self.ring_size = buffer_periods
+        self.ring_cond = threading.Condition()
+
+        self.periods = 0
+        self.underruns = 0
+        self.latencies = deque(maxlen=100)
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self.mix_loop, name="mixer", daemon=True),
+            threading.Thread(target=self.output_loop, name="mixer-output", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def alive(self):
+        return all(thread.is_alive() for thread in self.threads)
+
+    # convert pcm in any simpleaudio supported layout to the output format
+    def to_output(self,data,channels,sample_width,sample_rate):
+        if (channels, sample_width, sample_rate) != (self.channels, 2, self.sample_rate):
+            data = miniaudio.convert_frames(sample_format(sample_width), channels,
+                sample_rate, bytes(data), miniaudio.SampleFormat.SIGNED16, 
+                self.channels, self.sample_rate)
+        return np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+
+    def add(self,voice):
+        with self.lock:
+            self.voices.append(voice)
+        return voice
+
+    def play(self,wave_obj,gain=1.0,duck_class="foreground"):
+        samples = self.to_output(wave_obj.audio_data, wave_obj.num_channels,
+            wave_obj.bytes_per_sample, wave_obj.sample_rate)
+        return self.add(Voice(samples, gain, duck_class))
+
+    # a voice that is fed signed 16-bit pcm as it arrives; see feed_stream
+    def stream(self,sample_rate,channels=1,gain=1.0,duck_class="foreground"):
+        voice = Voice(np.zeros(0, dtype=np.float32), gain, duck_class, streaming=True)
+        voice.source_channels = channels
+        voice.resampler = None
+        if sample_rate != self.sample_rate:
+            voice.resampler = LinearResampler(sample_rate, self.sample_rate)
+        return self.add(voice)
+
+    def feed_stream(self,voice,pcm):
+        frames = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        frames = frames.reshape(-1, voice.source_channels)
+        if voice.resampler:
+            frames = voice.resampler.process(frames)
+        if voice.source_channels != self.channels:
+            if self.channels == 1:
+                frames = frames.mean(axis=1, keepdims=True)
+            else:
+                frames = np.repeat(frames[:, :1], self.channels, axis=1)
+        voice.feed(frames.reshape(-1))
+
+    def update_ducking(self,voices):
+        active = set(voice.duck_class for voice in voices)
+        for duck_class, (triggers, gain) in self.ducking.items():
+            target = gain if active & triggers else 1.0
+            level = self.duck_levels[duck_class]
+            if level < target:
+                level = min(target, level + self.DUCK_STEP)
+            elif level > target:
+                level = max(target, level - self.DUCK_STEP)
+            self.duck_levels[duck_class] = level
+
+    def mix_period(self):
+        out = np.zeros(self.period_samples, dtype=np.float32)
+        started = []
+        finished = []
+        with self.lock:
+            self.voices = [v for v in self.voices if not (v.finished or v.stopped)]
+            voices = list(self.voices)
+        self.update_ducking(voices)
+        for voice in voices:
+            chunk = voice.read(self.period_samples)
+            if len(chunk):
+                if not voice.started:
+                    voice.started = True
+                    started.append(voice)
+                out[:len(chunk)] += chunk * (voice.gain * self.duck_levels.get(voice.duck_class, 1.0))
+            if voice.finished:
+                finished.append(voice)
+        np.clip(out, -1.0, 1.0, out=out)
+        return (out * 32767).astype(np.int16).tobytes(), started, finished
+
+    def mix_loop(self):
+        while True:
+            block = self.mix_period()
+            with self.ring_cond:
+                while len(self.ring) >= self.ring_size:
+                    self.ring_cond.wait()
+                self.ring.append(block)
+                self.ring_cond.notify_all()
+
+    def output_loop(self):
+        while True:
+            with self.ring_cond:
+                if self.ring:
+                    pcm, started, finished = self.ring.popleft()
+                    self.ring_cond.notify_all()
+                else:
+                    pcm, started, finished = self.silence, [], []
+                    self.underruns += 1
+            self.sink.write(pcm)
+            self.periods += 1
+            now = monotonic()
+            for voice in started:
+                self.latencies.append(now - voice.queued_at)
+            for voice in finished:
+                voice.done.set()
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        with self.lock:
+            voices = len(self.voices)
+        return {
+            "voices": voices,
+            "periods": self.periods,
+            "underruns": self.underruns,
+            "buffered_periods": len(self.ring),
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+            "duck_levels": dict(self.duck_levels),
+        }
+
+# Collapses concurrent calls for the same key into one: the first caller 
+#  runs fn, later callers wait for and share its result (or exception).
+#  join / finish let a leader whose work is not a single call (a stream 
+#  consumed by its caller) hold the key until it is done.
+class SingleFlight():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    # (call, leader); the leader must finish the call
+    def join(self,key):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event()}
+                self.executed += 1
+            else:
+                self.shared += 1
+        return call, leader
+
+    def wait(self,call):
+        call["done"].wait()
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+    def finish(self,key,call,result=None,error=None):
+        if error is not None:
+            call["error"] = error
+        else:
+            call["result"] = result
+        with self.lock:
+            del self.calls[key]
+        call["done"].set()
+
+    def do(self,key,fn):
+        call, leader = self.join(key)
+        if not leader:
+            return self.wait(call)
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                "executed": self.executed,
+                "shared": self.shared,
+                "in_flight": len(self.calls),
+            }
+
+# [cache] pack_store = yes keeps TTS audio in pack files (see PackStore)
+def open_tts_database():
+    pack = None
+    if config.getboolean('cache', 'pack_store', fallback=False):
+        pack = PackStore("%s/pack" % CACHE_PATH,
+            config.getint('cache', 'pack_size_mb', fallback=64) * 1024 * 1024)
+    return TtsWaveformDatabase(TTS_WAVEFORM_DB_PATH, 
+        TTS_WAVEFORM_LEGACY_DB_PATH, pack)
+
+# Opt-in sharing of TTS cache entries between bridges over the broker
+#  ([federation] enabled). On a local miss a bridge asks its peers for the
+#  entry before calling polly. The request goes to one peer that announced
+#  the key, or to every peer for a key nobody announced (the first to 
+#  answer is listened to). The PCM comes in chunks, each with a sha1, the 
+#  first also carrying a sha1 of the whole. The
+#  entry is stored in the local database (converted to the local output 
+#  format if the peer's differs). A transfer that fails its checks, or no 
+#  answer within the timeout, falls back to polly. Newly synthesized entries
+#  are announced: peers then wait the full timeout for those keys (only 
+#  miss_timeout for keys nobody announced) and with prefetch fetch them at 
+#  once. Fetches go through inflight (the synthesizer's SingleFlight, when
+#  shared) so a prefetch and a local miss for one phrase make one entry.
+class TtsFederation():
+
+    def __init__(self,client,database,audio_format,node_id,topic_prefix="audiobridge/tts",
+            timeout=2.0,miss_timeout=0.3,chunk_size=32768,prefetch=False):
+
+        self.client = client
+        self.database = database
+        self.audio_format = audio_format
+        self.node_id = node_id
+        self.topic_prefix = topic_prefix
+        self.timeout = timeout
+        self.miss_timeout = miss_timeout
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.lock = threading.Lock()
+        # request id -> {"chunks", "done", "from", "meta", "error"}
+        self.pending = {}
+        # key -> node ids that announced it
+        self.peer_keys = {}
+        # requests are answered off the network thread
+        self.sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="federation")
+        self.inflight = SingleFlight()
+
+        self.requests = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.served = 0
+        self.announced = 0
+
+        self.client.message_callback_add(self.topic("#"), self.on_message)
+
+    def topic(self,*parts):
+        return "/".join((self.topic_prefix,) + parts)
+
+    # on every (re)connect
+    def subscribe(self):
+        for subscription in (self.topic("request"), self.topic("announce"),
+                self.topic("node", self.node_id, "#")):
+            self.client.subscribe(subscription, qos=1)
+
+    def on_message(self,client,userdata,msg):
+        kind = msg.topic[len(self.topic_prefix) + 1:].split("/")[0]
+        try:
+            if kind == "node":
+                self.receive(msg.payload)
+                return
+            message = json.loads(msg.payload)
+            if message.get("from") == self.node_id:
+                return
+            if kind == "request":
+                self.sender.submit(self.serve, message)
+            elif kind == "announce":
+                with self.lock:
+                    self.peer_keys.setdefault(message["key"], set()).add(message["from"])
+                if self.prefetch and message["key"] not in self.database.entries:
+                    threading.Thread(target=self.prefetch_entry, args=(message["key"], 
+                        message["text"], message["voice"], message["engine"], 
+                        message["text_type"]), name="federation-prefetch", 
+                        daemon=True).start()
+        except Exception as e:
+            logger.error("federation: bad message on '%s': %s" % (msg.topic, e.__repr__()))
+
+    def announce(self,key,text,voice,engine,text_type):
+        self.client.publish(self.topic("announce"), json.dumps({"key": key, 
+            "from": self.node_id, "text": text, "voice": voice, "engine": engine,
+            "text_type": text_type}), qos=1)
+        self.announced += 1
+
+    def prefetch_entry(self,key,text,voice,engine,text_type):
+        try:
+            self.inflight.do(key, lambda: self.database.get_tts(text,voice,engine,
+                text_type,touch=False) or self.fetch(key,text,voice,engine,text_type))
+        except Exception as e:
+            logger.warning("federation: prefetch of '%s' failed: %s" % (text, e.__repr__()))
+
+    # send an entry we hold to the peer asking for it, unless the request 
+    #  was addressed to another peer
+    def serve(self,request):
+        if request.get("to", self.node_id) != self.node_id:
+            return
+        tts = self.database.entries.get(request["key"])
+        if not tts:
+            return
+        try:
+            pcm, channels, width, rate = self.database.read_pcm(
+                "%s/%s" % (self.database.tts_cache_path, tts["filename"]))
+        except (OSError, EOFError, wave.Error) as e:
+            logger.warning("federation: unable to read '%s': %s" % (tts["filename"], e))
+            return
+        pcm = bytes(pcm)
+        count = max(1, math.ceil(len(pcm) / self.chunk_size))
+        topic = self.topic("node", request["from"], request["request_id"])
+        for seq in range(count):
+            chunk = pcm[seq * self.chunk_size:(seq + 1) * self.chunk_size]
+            header = {"request_id": request["request_id"], "from": self.node_id,
+                "seq": seq, "count": count, "sha1": hashlib.sha1(chunk).hexdigest()}
+            if seq == 0:
+                header.update(channels=channels, width=width, rate=rate, 
+                    length=len(pcm), digest=hashlib.sha1(pcm).hexdigest(),
+                    loudness=dict((k, tts[k]) for k in ("peak", "rms") if k in tts))
+            self.client.publish(topic, json.dumps(header).encode('utf-8') + b"\n" + chunk, qos=1)
+        with self.lock:
+            self.served += 1
+        logger.info("federation: sent '%s' to %s (%d bytes)" 
+            % (tts["text"], request["from"], len(pcm)))
+
+    def receive(self,payload):
+        header, _, chunk = bytes(payload).partition(b"\n")
+        header = json.loads(header)
+        with self.lock:
+            transfer = self.pending.get(header["request_id"])
+            if transfer is None or transfer["done"].is_set():
+                return
+            # only the first peer to answer is listened to
+            if transfer.setdefault("from", header["from"]) != header["from"]:
+                return
+            if hashlib.sha1(chunk).hexdigest() != header["sha1"]:
+                transfer["error"] = "chunk %d failed its checksum" % header["seq"]
+                transfer["done"].set()
+                return
+            if header["seq"] == 0:
+                transfer["meta"] = header
+            transfer["chunks"][header["seq"]] = chunk
+            if len(transfer["chunks"]) == header["count"] and "meta" in transfer:
+                transfer["done"].set()
+
+    # filename base of the entry fetched from a peer, or None
+    def fetch(self,key,text,voice,engine,text_type):
+        request_id = uuid.uuid4().hex
+        transfer = {"chunks": {}, "done": threading.Event()}
+        request = {"key": key, "request_id": request_id, "from": self.node_id}
+        with self.lock:
+            self.pending[request_id] = transfer
+            self.requests += 1
+            holders = self.peer_keys.get(key)
+            if holders:
+                request["to"] = random.choice(sorted(holders))
+        try:
+            self.client.publish(self.topic("request"), json.dumps(request), qos=1)
+            transfer["done"].wait(self.timeout if holders else self.miss_timeout)
+            # a peer that has started sending gets time to finish
+            if not transfer["done"].is_set() and "from" in transfer:
+                transfer["done"].wait(self.timeout)
+            with self.lock:
+                if not transfer["done"].is_set():
+                    self.timeouts += 1
+                    # it may have evicted the entry; ask another next time
+                    if "to" in request:
+                        holders.discard(request["to"])
+                        if not holders:
+                            self.peer_keys.pop(key, None)
+                    logger.debug("federation: no peer sent '%s'" % text)
+                    return None
+                error = transfer.get("error")
+                if not error:
+                    meta = transfer["meta"]
+                    pcm = b"".join(transfer["chunks"][seq] for seq in range(meta["count"]))
+                    if len(pcm) != meta["length"] or hashlib.sha1(pcm).hexdigest() != meta["digest"]:
+                        error = "audio failed its checksum"
+                if error:
+                    self.rejected += 1
+                    logger.warning("federation: rejected '%s' from %s: %s" 
+                        % (text, transfer["from"], error))
+                    return None
+        finally:
+            with self.lock:
+                self.pending.pop(request_id, None)
+
+        if not self.audio_format.matches(meta["channels"], meta["width"], meta["rate"]):
+            pcm = miniaudio.convert_frames(sample_format(meta["width"]), meta["channels"],
+                meta["rate"], pcm, miniaudio.SampleFormat.SIGNED16,
+                self.audio_format.channels, self.audio_format.sample_rate)
+
+        filename_base = self.database.next_filename()
+        tmp_path = "%s.%s.wav" % (filename_base, request_id)
+        with wave.open(tmp_path, 'wb') as wav:
+            wav.setnchannels(self.audio_format.channels)
+            wav.setsampwidth(AudioFormat.SAMPLE_WIDTH)
+            wav.setframerate(self.audio_format.sample_rate)
+            wav.writeframes(pcm)
+        os.replace(tmp_path, filename_base + ".wav")
+        self.database.add_tts(text,filename_base,['wav'],voice,engine,text_type,
+            meta["loudness"] or None,self.audio_format)
+        with self.lock:
+            self.received += 1
+            self.received_bytes += len(pcm)
+        logger.info("federation: received '%s' from %s (%d bytes)" 
+            % (text, transfer["from"], len(pcm)))
+        return filename_base
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "received": self.received,
+                "received_bytes": self.received_bytes,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "served": self.served,
+                "announced": self.announced,
+                "peer_keys": len(self.peer_keys),
+            }
+
+# One synthesizer is shared by the whole process. The boto3 client (and its
+#  pooled, keep-alive HTTPS connections) is created once and warmed in the
+#  background at startup so the first cache miss does not pay for credential
+#  resolution and a TLS handshake. endpoint_url points it at a local stub.
+class Polly():
+
+    OUTPUT_FORMAT='ogg_vorbis'
+
+    def __init__(self,database=None,region='us-west-2',endpoint_url=None,
+            max_concurrency=2,audio_format=None):
+        if database is None:
+            database = open_tts_database()
+        self.database = database
+        # cached speech is converted to this; see negotiate_output_format
+        self.audio_format = audio_format or AudioFormat()
+        self.aws_config = dict(
+            region_name = region,
+            signature_version = 'v4',
+            max_pool_connections = max_concurrency,
+            tcp_keepalive = True,
+            retries = {
+                'max_attempts': 10,
+                'mode': 'standard'
+            }
+        )
+        self.endpoint_url = endpoint_url
+        self.client_lock = threading.Lock()
+        self._client = None
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.inflight = SingleFlight()
+        # a TtsFederation, set by the bridge when [federation] is enabled
+        self.federation = None
+
+    # boto3 is imported and the client built on first use (normally by warm)
+    @property
+    def client(self):
+        with self.client_lock:
+            if self._client is None:
+                self._client = boto3.client('polly', 
+                    config=botocore_config.Config(**self.aws_config),
+                    endpoint_url=self.endpoint_url)
+            return self._client
+
+    # open a connection and resolve credentials ahead of the first request
+    def warm(self):
+        def run():
+            try:
+                self.client.describe_voices(LanguageCode='en-US')
+                logger.info("polly client warmed (%s)" 
+                    % (self.endpoint_url or self.aws_config["region_name"]))
+            except Exception as e:
+                logger.warning("unable to warm polly client: %s" % e.__repr__())
+        threading.Thread(target=run, name="polly-warm", daemon=True).start()
+
+    def synthesize(self,**kwargs):
+        with self.slots, metrics.timer("polly"):
+            return self.client.synthesize_speech(**kwargs)
+
+    # ssml marks text that is already a complete <speak> document
+    def request_params(self,text,voice=None,ssml=False):
+        
+        if not voice: 
+            voice = TTS_DEFAULT_VOICE
+        
+        engine = "neural"
+        text_type = "text"
+        text_request = text
+
+        if ssml:
+            text_type = "ssml"
+        elif voice == "Matthew":
+            print("detected request for matthew")
+            text_type = "ssml"
+            text_request = "<speak><amazon:domain name=\"conversational\">%s</amazon:domain></speak>" % text
+            # <amazon:effect name="drc"> </amazon:effect>
+
+        return voice, engine, text_type, text_request
+
+    def cached_waveform(self,text,voice=None,ssml=False):
+        voice, engine, text_type, text_request = self.request_params(text,voice,ssml)
+        return self.database.get_tts(text,voice,engine,text_type,touch=False)
+
+    def get_waveform(self,text,voice=None,ssml=False):
+        
+        voice, engine, text_type, text_request = self.request_params(text,voice,ssml)
+
+        # Check for cache first!
+        with metrics.timer("tts_cache_lookup"):
+            filename_base = self.database.get_tts(text,voice,engine,text_type)
+        if not filename_base:
+            # concurrent misses for the same phrase share one polly call
+            key = self.database.key(text,voice,engine,text_type)
+            filename_base = self.inflight.do(key, lambda: self.fetch_waveform(
+                text,voice,engine,text_type,text_request))
+            
+        return filename_base
+
+    def fetch_waveform(self,text,voice,engine,text_type,text_request):
+
+        # another caller may have finished the same phrase just before us
+        filename_base = self.database.get_tts(text,voice,engine,text_type,touch=False)
+        if filename_base:
+            return filename_base
+
+        # a peer may already have it
+        if self.federation:
+            filename_base = self.federation.fetch(self.database.key(text,voice,
+                engine,text_type),text,voice,engine,text_type)
+            if filename_base:
+                return filename_base
+
+        pollyResponse = self.synthesize(
+            Engine=engine, Text=text_request, OutputFormat=self.OUTPUT_FORMAT, 
+            TextType=text_type,VoiceId=voice)
+
+        filename_base = self.database.next_filename()
+
+        filename_ogg = filename_base + ".ogg"
+        with open(filename_ogg, 'wb') as f:
+            f.write(pollyResponse['AudioStream'].read())
+
+        filename_wav = filename_base + ".wav"
+        convert_audio_file(filename_ogg,filename_wav,self.audio_format.channels,
+            self.audio_format.sample_rate)
+        
+        self.database.add_tts(text,filename_base,['wav','ogg'],voice,
+            engine,text_type,measure_loudness(filename_wav),self.audio_format)
+        if self.federation:
+            self.federation.announce(self.database.key(text,voice,engine,text_type),
+                text,voice,engine,text_type)
+        return filename_base
+
+    # Request raw PCM and yield it chunk by chunk as it arrives so playback 
+    #  can begin before synthesis has finished. The same samples are written
+    #  to a wav in the TTS cache as they pass through; the entry is only
+    #  added to the database once the stream has been fully received, after
+    #  the wav has been converted to the output format like any other entry.
+    #  Streaming holds the phrase's in-flight slot, so only one caller 
+    #  streams it. Yields nothing if a peer had the phrase, or (once it is 
+    #  cached) if another caller was already synthesizing it; get_waveform 
+    #  then finds the entry.
+    def stream_waveform(self,text,voice=None,chunk_size=PCM_CHUNK_SIZE):
+
+        voice, engine, text_type, text_request = self.request_params(text,voice)
+        key = self.database.key(text,voice,engine,text_type)
+
+        call, leader = self.inflight.join(key)
+        if not leader:
+            self.inflight.wait(call)
+            return
+        filename_base = None
+        error = RuntimeError("stream of '%s' was abandoned" % text)
+        try:
+            filename_base = self.database.get_tts(text,voice,engine,text_type,touch=False)
+            if not filename_base and self.federation:
+                filename_base = self.federation.fetch(key,text,voice,engine,text_type)
+            if not filename_base:
+                filename_base = yield from self.stream_pcm(text,voice,engine,
+                    text_type,text_request,chunk_size)
+            error = None
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.inflight.finish(key, call, filename_base, error)
+
+    # the polly request behind stream_waveform; returns the new entry
+    def stream_pcm(self,text,voice,engine,text_type,text_request,chunk_size):
+
+        pollyResponse = self.synthesize(
+            Engine=engine, Text=text_request, OutputFormat='pcm',
+            SampleRate=str(PCM_SAMPLE_RATE), TextType=text_type, VoiceId=voice)
+
+        filename_base = self.database.next_filename()
+        filename_wav = filename_base + ".wav"
+        complete = False
+        try:
+            with wave.open(filename_wav, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(PCM_SAMPLE_RATE)
+                for chunk in pollyResponse['AudioStream'].iter_chunks(chunk_size):
+                    wav.writeframesraw(chunk)
+                    yield chunk
+            if not self.audio_format.matches(1, 2, PCM_SAMPLE_RATE):
+                self.conform_wav(filename_wav)
+            complete = True
+        finally:
+            pollyResponse['AudioStream'].close()
+            if complete:
+                self.database.add_tts(text,filename_base,['wav'],voice,
+                    engine,text_type,measure_loudness(filename_wav),
+                    self.audio_format)
+                if self.federation:
+                    self.federation.announce(self.database.key(text,voice,engine,
+                        text_type),text,voice,engine,text_type)
+            else:
+                Path(filename_wav).unlink(missing_ok=True)
+        return filename_base
+
+    # rewrite a streamed (mono, PCM_SAMPLE_RATE) wav in the output format
+    def conform_wav(self,filename_wav):
+        with wave.open(filename_wav, 'rb') as wav:
+            pcm = wav.readframes(wav.getnframes())
+        pcm = miniaudio.convert_frames(miniaudio.SampleFormat.SIGNED16, 1,
+            PCM_SAMPLE_RATE, pcm, miniaudio.SampleFormat.SIGNED16,
+            self.audio_format.channels, self.audio_format.sample_rate)
+        tmp_path = "%s/.%s" % (path.dirname(filename_wav), path.basename(filename_wav))
+        with wave.open(tmp_path, 'wb') as wav:
+            wav.setnchannels(self.audio_format.channels)
+            wav.setsampwidth(AudioFormat.SAMPLE_WIDTH)
+            wav.setframerate(self.audio_format.sample_rate)
+            wav.writeframes(pcm)
+        os.replace(tmp_path, filename_wav)
+        
+# Synthesizes a list of phrases known ahead of time into the TTS cache so 
+#  their first play does not wait on polly. Phrases are requested from a few
+#  threads, spaced to at most `rate` requests per second across all of them,
+#  and retried with exponential backoff (with jitter) when a request fails.
+class Presynthesizer():
+
+    def __init__(self,tts,workers=4,rate=5.0,attempts=4,backoff=1.0):
+        self.tts = tts
+        self.workers = workers
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.attempts = attempts
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.next_slot = monotonic()
+        self.retries = 0
+
+    # phrase file: one phrase per line as text[<tab>voice[<tab>ssml]], where
+    #  ssml is yes/true/1 for text that is already a <speak> document; blank
+    #  lines and lines starting with # are skipped
+    @staticmethod
+    def read_phrases(filename):
+        phrases = []
+        with open(filename) as f:
+            for line in f:
+                line = line.rstrip("\r\n")
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                fields = line.split("\t")
+                text = fields[0].strip()
+                voice = fields[1].strip() if len(fields) > 1 and fields[1].strip() else None
+                ssml = len(fields) > 2 and fields[2].strip().lower() in ("1", "yes", "true", "ssml")
+                phrases.append((text, voice, ssml))
+        return phrases
+
+    # wait for the next request slot
+    def throttle(self):
+        with self.lock:
+            now = monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+    # "hits", "new" or "failed"
+    def synthesize(self,text,voice,ssml):
+        if self.tts.cached_waveform(text,voice,ssml):
+            return "hits"
+        for attempt in range(self.attempts):
+            self.throttle()
+            try:
+                self.tts.get_waveform(text,voice,ssml)
+                return "new"
+            except Exception as e:
+                if attempt + 1 == self.attempts:
+                    logger.error("unable to synthesize '%s': %s" % (text, e.__repr__()))
+                    return "failed"
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+                logger.warning("synthesis of '%s' failed (%s); retrying in %.1fs" 
+                    % (text, e.__repr__(), delay))
+                with self.lock:
+                    self.retries += 1
+                sleep(delay)
+
+    # hand phrases to the running bridge, which owns the TTS database, as a
+    #  {MQTT_TOPIC_PREFIX}/presynthesize/json message
+    @staticmethod
+    def send_phrases(phrases,rate):
+        client = mqtt.Client()
+        client.connect(config['mqtt']['host'], config.getint('mqtt', 'port', fallback=1883))
+        client.loop_start()
+        try:
+            info = client.publish(f"{MQTT_TOPIC_PREFIX}/presynthesize/json", json.dumps({
+                "rate": rate, "phrases": [{"text": text, "voice": voice, "ssml": ssml}
+                    for text, voice, ssml in phrases]}), qos=1)
+            info.wait_for_publish()
+        finally:
+            client.loop_stop()
+            client.disconnect()
+
+    def run(self,phrases):
+        phrases = list(dict.fromkeys(phrases))
+        counts = {"hits": 0, "new": 0, "failed": 0}
+        started = monotonic()
+        report_every = max(1, len(phrases) // 20)
+        with ThreadPoolExecutor(max_workers=self.workers, 
+                thread_name_prefix="presynth") as pool:
+            futures = [pool.submit(self.synthesize, text, voice, ssml) 
+                for text, voice, ssml in phrases]
+            for done, future in enumerate(as_completed(futures), 1):
+                counts[future.result()] += 1
+                if done % report_every == 0 or done == len(futures):
+                    logger.info("presynthesis %d/%d: %d hits, %d new, %d failed" % (done,
+                        len(futures), counts["hits"], counts["new"], counts["failed"]))
+        logger.info("presynthesis finished in %.1fs (%d retries)" 
+            % (monotonic() - started, self.retries))
+        return counts
+
+# -- Templated speech
+# Phrases such as "volume {volume}" or "temperature is {value} degrees" are
+#  split into fixed fragments and slot values, each synthesized and cached as
+#  its own TTS entry. Numbers are spoken from a small closed set of fragments
+#  ("forty two", "hundred", "point", "five", ...) so that once warm, a whole
+#  family of messages plays without touching the network. Fragments are 
+#  trimmed of the silence Polly pads them with and joined with a short 
+#  crossfade.
+
+NUMBER_ONES = ["zero", "one", "two", "three", "four", "five", "six", "seven",
+    "eight", "nine", "ten", "eleven", "twelve", "thirteen", "fourteen", 
+    "fifteen", "sixteen", "seventeen", "eighteen", "nineteen"]
+NUMBER_TENS = ["", "", "twenty", "thirty", "forty", "fifty", "sixty", 
+    "seventy", "eighty", "ninety"]
+NUMBER_SCALES = [(1000000000, "billion"), (1000000, "million"), (1000, "thousand")]
+
+# 0 - 99 as a single fragment
+def number_below_100(value):
+    if value < 20:
+        return NUMBER_ONES[value]
+    tens, ones = divmod(value, 10)
+    if ones:
+        return "%s %s" % (NUMBER_TENS[tens], NUMBER_ONES[ones])
+    return NUMBER_TENS[tens]
+
+def number_below_1000(value):
+    fragments = []
+    hundreds, rest = divmod(value, 100)
+    if hundreds:
+        fragments += [NUMBER_ONES[hundreds], "hundred"]
+    if rest or not hundreds:
+        fragments.append(number_below_100(rest))
+    return fragments
+
+NUMBER_PLAIN = re.compile(r"-?(\d+\.?\d*|\.\d+)")
+NUMBER_LIMIT = NUMBER_SCALES[0][0] * 1000
+
+# digits of a number as written, or fixed-point for floats and exponent 
+#  notation (1e-05 -> 0.00001) so it can be spelled digit by digit
+def number_text(value):
+    text = str(value).strip()
+    if NUMBER_PLAIN.fullmatch(text) and not isinstance(value, float):
+        return text
+    return ("%.6f" % float(text)).rstrip("0").rstrip(".")
+
+# spoken fragments of a number, e.g. -21.5 -> minus, twenty one, point, five
+def number_fragments(value):
+    text = number_text(value)
+    fragments = []
+    if text.startswith("-"):
+        fragments.append("minus")
+        text = text[1:]
+    whole, _, decimals = text.partition(".")
+    whole = int(whole or 0)
+    for scale, name in NUMBER_SCALES:
+        if whole >= scale:
+            count, whole = divmod(whole, scale)
+            fragments += number_below_1000(count) + [name]
+    if whole or not fragments or fragments == ["minus"]:
+        fragments += number_below_1000(whole)
+    if decimals:
+        fragments.append("point")
+        fragments += [NUMBER_ONES[int(digit)] for digit in decimals]
+    return fragments
+
+# whether number_fragments can spell value; anything else (bools, nan, inf, 
+#  a trillion and up) is spoken as text
+def is_number(value):
+    if isinstance(value, bool):
+        return False
+    try:
+        number = float(str(value))
+    except (ValueError, OverflowError):
+        return False
+    return math.isfinite(number) and abs(number) < NUMBER_LIMIT
+
+class TemplatedSpeech():
+
+    SLOT = re.compile(r"\{(\w+)\}")
+
+    def __init__(self,tts,executor=None,crossfade_ms=30,silence_threshold=0.01):
 
+        self.tts = tts
+        self.executor = executor
+        self.crossfade_ms = crossfade_ms
+        self.silence_threshold = silence_threshold
+        self.rendered = 0
+        self.fragments_synthesized = 0
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-logger = logging.getLogger("AudioBridge")
+    def fragments(self,template,values):
+        fragments = []
+        for index, part in enumerate(self.SLOT.split(template)):
+            if index % 2:
+                value = values[part]
+                if is_number(value):
+                    fragments += number_fragments(value)
+                else:
+                    fragments.append(str(value))
+            elif part.strip():
+                fragments.append(part.strip())
+        return fragments
 
-# requires packages: miniaudio, array
-def convert_audio_miniaudio(in_file, out_file):
+    def waveform(self,fragment,voice):
+        if not self.tts.cached_waveform(fragment,voice):
+            self.fragments_synthesized += 1
+        return self.tts.get_waveform(fragment,voice)
 
-    channels = 1
-    sample_rate = 44100
+    # load a fragment's wav and drop leading and trailing silence, keeping 
+    #  a few milliseconds either side so word onsets are not clipped. 
+    #  Fragments cached in another format (before a --rerender) are 
+    #  converted to the output format so they can be joined.
+    def load(self,filename_base):
+        pcm, channels, width, rate = self.tts.database.read_pcm(filename_base)
+        if width != 2:
+            raise ValueError("fragment '%s' is not 16-bit" % filename_base)
+        audio_format = self.tts.audio_format
+        if not audio_format.matches(channels, width, rate):
+            pcm = miniaudio.convert_frames(miniaudio.SampleFormat.SIGNED16, 
+                channels, rate, bytes(pcm), miniaudio.SampleFormat.SIGNED16,
+                audio_format.channels, audio_format.sample_rate)
+            channels, rate = audio_format.channels, audio_format.sample_rate
+        params = (channels, width, rate)
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        frames = samples.reshape(-1, channels)
+        loud = np.nonzero(np.abs(frames).max(axis=1) > self.silence_threshold * 32768)[0]
+        if loud.size:
+            margin = rate // 200
+            frames = frames[max(0, loud[0] - margin):loud[-1] + margin + 1]
+        return frames, params
 
-    src = miniaudio.decode_file(in_file) # , dither=miniaudio.DitherMode.TRIANGLE
-    
-    # DecodedSoundFile - Contains various properties and also the PCM frames of 
-    #  a fully decoded audio file.
-    tgt = miniaudio.DecodedSoundFile("result", 1, sample_rate, 
-        miniaudio.SampleFormat.SIGNED16, array.array('b'))
-    
-    converted_frames = miniaudio.convert_frames(
-        src.sample_format, src.nchannels, src.sample_rate, src.samples.tobytes(),
-        tgt.sample_format, tgt.nchannels, tgt.sample_rate)
-    
-    tgt.num_frames = int(len(converted_frames) / tgt.nchannels / tgt.sample_width)
-    tgt.samples.frombytes(converted_frames)
+    def join(self,segments,rate):
+        overlap = int(rate * self.crossfade_ms / 1000)
+        out = segments[0].astype(np.float32)
+        for segment in segments[1:]:
+            segment = segment.astype(np.float32)
+            fade = min(overlap, len(out), len(segment))
+            if fade:
+                ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)[:, None]
+                blended = out[-fade:] * (1 - ramp) + segment[:fade] * ramp
+                out = np.concatenate((out[:-fade], blended, segment[fade:]))
+            else:
+                out = np.concatenate((out, segment))
+        return np.clip(out, -32768, 32767).astype(np.int16)
 
-    miniaudio.wav_write_file(out_file, tgt)
-    
-    logger.debug("wrote converted file to '%s'" % out_file)
-    
-    return False
+    # synthesize (or fetch from cache) every fragment and join them into
+    #  a single WaveObject
+    def render(self,template,values,voice=None):
+        fragments = self.fragments(template,values)
+        if not fragments:
+            return None
+        if self.executor:
+            bases = list(self.executor.map(lambda f: self.waveform(f,voice), fragments))
+        else:
+            bases = [self.waveform(f,voice) for f in fragments]
+        loaded = [self.load(base) for base in bases]
+        params = loaded[0][1]
+        if any(p != params for segment, p in loaded):
+            raise ValueError("fragments of '%s' differ in format" % template)
+        channels, width, rate = params
+        pcm = self.join([segment for segment, p in loaded], rate)
+        self.rendered += 1
+        logger.debug("rendered '%s' from %d fragments" % (template, len(fragments)))
+        return simpleaudio.WaveObject(pcm.tobytes(), channels, width, rate)
 
-# use ffmpeg to convert files -- significantly slower process
-#  only to be used if miniaudio is unable
-def convert_audio_ffmpeg(filename_input, filename_output):
-    
-    filename_input = str(filename_input) # "'%s'" % filename_input
-    filename_output = str(filename_output) # "'%s'" % filename_output
-    
-    # ffmpeg -i input.mp3 output.ogg
-    channels = 1
-    sample_rate = 44100
+    def stats(self):
+        return {
+            "rendered": self.rendered,
+            "fragments_synthesized": self.fragments_synthesized,
+        }
 
-    # -v fatal - Only show fatal errors. These are errors after which the 
-    #            process absolutely cannot continue. 
-    ffmpeg = subprocess.run(["/usr/bin/ffmpeg", "-v", "fatal", "-hide_banner", "-nostdin",
-                           "-i", filename_input, "-acodec", "pcm_s16le",
-                           "-ac", str(channels), "-ar", str(sample_rate), filename_output],
-                           capture_output=True, timeout=15)
+# A unit of work for the playback worker; fn(request) does the synthesis,
+#  conversion and playback so none of it runs in the MQTT callback
+class PlaybackRequest():
 
-    logger.debug("called: %s" % ' '.join(ffmpeg.args))
+    def __init__(self,fn,description,priority=PRIORITY_NORMAL,ttl=None):
+        self.fn = fn
+        self.description = description
+        self.priority = priority
+        self.enqueued_at = monotonic()
+        self.expires_at = self.enqueued_at + ttl if ttl else None
+        self.cancelled = threading.Event()
+        self.trace_id = current_trace_id()
 
-    if ffmpeg.returncode:
-        logger.debug("ffmpeg return code: % s" % ffmpeg.returncode)
-        logger.debug("ffmpeg stdout: % s" % ffmpeg.stdout)
-        logger.debug("ffmpeg stderr: % s" % ffmpeg.stderr)
-    
-    return ffmpeg.returncode
+    def expired(self,now=None):
+        if self.expires_at is None:
+            return False
+        return (now or monotonic()) > self.expires_at
 
-def convert_audio_file(filename_src, filename_dst):
-    logger.debug("converting '%s' to '%s'." % (filename_src,filename_dst))
-    convert_audio_miniaudio(filename_src, filename_dst)
+# Single playback worker fed by a bounded priority queue. Requests past their
+#  expiry are dropped rather than played late. A request at or above the 
+#  preempt priority interrupts a lower priority request that is playing.
+class PlaybackScheduler():
 
-class Polly():
+    def __init__(self,maxsize=16,preempt_priority=PRIORITY_URGENT,name="playback"):
 
-    OUTPUT_FORMAT='ogg_vorbis'
+        self.name = name
+        self.maxsize = maxsize
+        self.preempt_priority = preempt_priority
+        self.queue = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.current = None
+        self.current_play = None
+        self.worker = None
 
-    def __init__(self):
-        self.database = TtsWaveformDatabase(TTS_WAVEFORM_DB_PATH)
-        self.aws_config = Config(
-            region_name = 'us-west-2',
-            signature_version = 'v4',
-            retries = {
-                'max_attempts': 10,
-                'mode': 'standard'
+        self.enqueued = 0
+        self.completed = 0
+        self.expired = 0
+        self.dropped = 0
+        self.preempted = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        self.worker = threading.Thread(target=self.run, 
+            name=self.name, daemon=True)
+        self.worker.start()
+
+    def submit(self,request):
+        with self.cond:
+            self.purge_expired()
+            if len(self.queue) >= self.maxsize:
+                # evict the least important, newest request if the new one 
+                #  outranks it; otherwise refuse the new one
+                worst = max(self.queue)
+                if worst[0] <= request.priority:
+                    self.dropped += 1
+                    logger.warning("playback queue full; dropping '%s'" % request.description)
+                    return False
+                self.queue.remove(worst)
+                heapq.heapify(self.queue)
+                self.dropped += 1
+                logger.warning("playback queue full; evicted '%s'" % worst[2].description)
+
+            heapq.heappush(self.queue, (request.priority, next(self.counter), request))
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+
+            current = self.current
+            if (current and request.priority <= self.preempt_priority and 
+                    request.priority < current.priority):
+                self.preempt(current)
+
+            self.cond.notify()
+        return True
+
+    def preempt(self,request):
+        logger.info("preempting '%s'" % request.description)
+        request.cancelled.set()
+        self.preempted += 1
+        play_obj = self.current_play
+        if play_obj:
+            play_obj.stop()
+
+    # caller holds self.cond
+    def purge_expired(self):
+        now = monotonic()
+        live = [item for item in self.queue if not item[2].expired(now)]
+        if len(live) != len(self.queue):
+            for item in self.queue:
+                if item[2].expired(now):
+                    logger.info("dropping expired request '%s'" % item[2].description)
+            self.expired += len(self.queue) - len(live)
+            self.queue = live
+            heapq.heapify(self.queue)
+
+    def next_request(self):
+        with self.cond:
+            while True:
+                while not self.queue:
+                    self.cond.wait()
+                priority, seq, request = heapq.heappop(self.queue)
+                if request.expired():
+                    self.expired += 1
+                    logger.info("dropping expired request '%s'" % request.description)
+                    continue
+                self.current = request
+                return request
+
+    def run(self):
+        while True:
+            request = self.next_request()
+            set_trace_id(request.trace_id)
+            wait = monotonic() - request.enqueued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            metrics.observe("queue_wait", wait)
+            logger.debug("starting '%s' after %.3fs in queue" % (request.description, wait))
+            try:
+                with metrics.timer("request"):
+                    request.fn(request)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("playback of '%s' failed: %s" % (request.description, e.__repr__()))
+            finally:
+                with self.cond:
+                    self.current = None
+                    self.current_play = None
+            logger.debug("playback queue: %s" % self.stats())
+            set_trace_id(None)
+
+    # play a simpleaudio WaveObject on behalf of the current request and wait
+    #  for it, unless the request is preempted first
+    def play(self,wave_obj,player=None):
+        request = self.current
+        if request and request.cancelled.is_set():
+            return False
+        play_obj = player(wave_obj) if player else wave_obj.play()
+        if request:
+            metrics.observe("playback_start", monotonic() - request.enqueued_at)
+        return self.wait(play_obj)
+
+    # make play_obj the one a preempting request stops
+    def attach(self,play_obj):
+        request = self.current
+        with self.cond:
+            self.current_play = play_obj
+            if request and request.cancelled.is_set():
+                play_obj.stop()
+
+    def wait(self,play_obj):
+        request = self.current
+        self.attach(play_obj)
+        with metrics.timer("playback"):
+            play_obj.wait_done()
+        with self.cond:
+            self.current_play = None
+        return not (request and request.cancelled.is_set())
+
+    def cancelled(self):
+        request = self.current
+        return bool(request and request.cancelled.is_set())
+
+    def stats(self):
+        with self.cond:
+            started = self.completed + self.failed
+            return {
+                "depth": len(self.queue),
+                "max_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "expired": self.expired,
+                "dropped": self.dropped,
+                "preempted": self.preempted,
+                "wait_avg": self.wait_total / started if started else 0.0,
+                "wait_max": self.wait_max,
             }
-        )
 
-    def get_waveform(self,text,voice=None):
-        
-        if not voice: 
-            voice = TTS_DEFAULT_VOICE
+# One output: a sound card with its ALSA mixers, a mixing engine and a 
+#  playback worker of its own. Zones are defined by [zone:<name>] sections in
+#  config.ini; without any, a single "default" zone is built from [general]
+#  and [output] and the card with an "Auto Gain Control" mixer, as before.
+class OutputZone():
+
+    def __init__(self,name,pcm_device,cardindex,audio_format,sink_type='alsa',
+            sink_file='output.wav',master_cardindex=-1,master_control="Master",
+            device_control="Speaker"):
+
+        self.name = name
+        self.pcm_device = pcm_device
+        self.cardindex = cardindex
+        self.audio_format = audio_format
+        self.sink_type = sink_type
+        self.sink_file = sink_file
+
+        self.scheduler = PlaybackScheduler(
+            config.getint('general', 'playback_queue_size', fallback=16),
+            name="playback-%s" % name)
+        self.scheduler.start()
+
+        # set a default volume
+        self.master_volume = 30
         
-        engine = "neural"
-        text_type = "text"
-        text_request = text
+        # volume set requests are generally set as retain
+        # we do not want to announce a volume change on start of this script
+        self.volume_is_set = False
 
-        if voice == "Matthew":
-            print("detected request for matthew")
-            text_type = "ssml"
-            text_request = "<speak><amazon:domain name=\"conversational\">%s</amazon:domain></speak>" % text
-            # <amazon:effect name="drc"> </amazon:effect>
+        # Set Mute OFF and device volume to 100%
+        self.device_mixer = None
+        if device_control:
+            self.device_mixer = alsa.Mixer(control=device_control, cardindex=cardindex)
+            self.device_mixer.setmute(0)
+            self.device_mixer.setvolume(100)
 
-        # Check for cache first!
-        filename_base = self.database.get_tts(text,voice)
-        if not filename_base:
-            
-            # now we initialize the AWS Polly client
-            polly = boto3.client('polly', config=self.aws_config)
-            
-            pollyResponse = polly.synthesize_speech(
-                Engine=engine, Text=text_request, OutputFormat=self.OUTPUT_FORMAT, 
-                TextType=text_type,VoiceId=voice)
+        # unmute master mixer and set volume to default
+        # with software gain the mixer is left at vol_absolute_max and each
+        #  sound is scaled in software instead of changing the mixer per play
+        self.mixer = self.create_mixer()
+        self.software_gain = (self.mixer is not None or 
+            config.getboolean('general', 'software_gain', fallback=True))
+        self.vol_absolute_max = int(config['general']['vol_absolute_max'])
+        self.master_mixer = alsa.Mixer(control=master_control, cardindex=master_cardindex)
+        self.master_mixer.setmute(0)
+        if self.software_gain:
+            self.master_mixer.setvolume(self.vol_absolute_max)
+        else:
+            self.master_mixer.setvolume(self.master_volume)
 
-            filename_base = self.database.next_filename()
+    # [output] engine = mixer (default) keeps one output stream open and mixes
+    #  sounds into it; engine = simpleaudio opens a stream per sound as before
+    def create_mixer(self):
+        if config.get('output', 'engine', fallback='mixer') != 'mixer':
+            return None
+        sample_rate = self.audio_format.sample_rate
+        channels = self.audio_format.channels
+        period_frames = config.getint('output', 'period_frames', fallback=1024)
+        if self.sink_type == 'null':
+            sink = NullSink(sample_rate, channels, period_frames)
+        elif self.sink_type == 'file':
+            sink = FileSink(self.sink_file, sample_rate, channels, period_frames)
+        else:
+            sink = AlsaSink(self.pcm_device, sample_rate, channels, period_frames)
+        duck_gain = config.getfloat('output', 'duck_gain', fallback=0.3)
+        alert_duck_gain = config.getfloat('output', 'alert_duck_gain', fallback=0.5)
+        mixer = AudioMixer(sink, sample_rate, channels, period_frames,
+            config.getint('output', 'buffer_periods', fallback=4),
+            ducking={
+                "background": ({"foreground", "alert", "speech"}, duck_gain),
+                "alert": ({"speech"}, alert_duck_gain),
+            })
+        mixer.start()
+        logger.info("zone %s: mixer started: %s sink, %d Hz, %d channel(s), %d frame periods" 
+            % (self.name, self.sink_type, sample_rate, channels, period_frames))
+        return mixer
 
-            filename_ogg = filename_base + ".ogg"
-            with open(filename_ogg, 'wb') as f:
-                f.write(pollyResponse['AudioStream'].read())
+    def restore_volume(self):
+        # only set volume if it is not currently what we are looking for
+        with metrics.timer("mixer"):
+            if self.master_mixer.getvolume()[0] != self.master_volume:
+                logger.debug(f"master_mixer.setvolume -> {self.master_volume}")
+                self.master_mixer.setvolume(self.master_volume)
 
-            filename_wav = filename_base + ".wav"
-            convert_audio_file(filename_ogg,filename_wav)
-            
-            self.database.add_tts(text,filename_base,['wav','ogg'],voice)
-            
-        return filename_base
+    def set_volume(self,value,temp=False):
         
+        if isinstance(value,str):
+            value = int(float(value))
+
+        if isinstance(value,float):
+            value = int(value)
+
+        if value >= 0 and value <= 100:
+            # the mixer stays at vol_absolute_max in software gain mode; the
+            #  master volume is then only the default for json requests
+            if not self.software_gain:
+                with metrics.timer("mixer"):
+                    self.master_mixer.setvolume(value)
+            if not temp:
+                self.master_volume = value
+        else:
+            logger.error("ERROR: cannot set volume to '%s'. Must be between 0 and 1." % value)
+
 class AudioBridge():
 
     def __init__(self):
 
+        self.startup_started = self.startup_phase_started = monotonic()
+        self.startup_timings = {}
+
         self.sounds_cache_path = f"{CACHE_PATH}/sounds"
         cachePath = Path(self.sounds_cache_path)
 
         if cachePath.exists():
-            files = cachePath.glob('*')
-            logger.info(f"cache path: {self.sounds_cache_path} ({len(list(files))} files)")
+            logger.info(f"cache path: {self.sounds_cache_path}")
         else:
             logger.info(f"cache path: {self.sounds_cache_path} - not found; creating!")
             cachePath.mkdir(parents=True,exist_ok=True)
 
-        self.mqttc = mqtt.Client("hmi-audio")
+        # zone names are read up front; cached audio is converted to the 
+        #  format of the first zone's device
+        self.zone_sections = [section for section in config.sections() 
+            if section.startswith("zone:")]
+        self.audio_format = negotiate_output_format(output_device())
+        self.startup_mark("output format")
+
+        # converted files live under CACHE_PATH; the index only covers sources
+        self.sound_index = SoundLibraryIndex(SOUNDS_PATH,
+            config.getint('general', 'sound_index_poll_interval', fallback=30),
+            exclude=[CACHE_PATH])
+        self.sound_index.start()
+
+        self.sound_converter = SoundConverter(SOUNDS_PATH, self.sounds_cache_path,
+            config.getint('general', 'conversion_workers', fallback=0) or None,
+            self.audio_format)
+        self.sound_converter.start()
+        self.startup_mark("sound library")
+
+        pinned = config.get('general', 'pinned_sounds', fallback='')
+        self.wave_cache = WaveObjectCache(
+            config.getint('general', 'pcm_cache_mb', fallback=32) * 1024 * 1024,
+            [name.strip() for name in pinned.split(',') if name.strip()])
+
+        self.request_ttl = config.getfloat('general', 'playback_ttl', fallback=60)
+
+        self.tts = Polly(
+            region=config.get('polly', 'region', fallback='us-west-2'),
+            endpoint_url=config.get('polly', 'endpoint_url', fallback=None),
+            max_concurrency=config.getint('polly', 'max_concurrency', fallback=2),
+            audio_format=self.audio_format)
+        self.tts.warm()
+        self.startup_mark("tts database")
+
+        self.cache_manager = CacheManager(self.tts.database, self.sound_converter,
+            config.getint('cache', 'budget_mb', fallback=0) * 1024 * 1024,
+            config.getint('cache', 'interval', fallback=600),
+            config.get('cache', 'tts_keep', fallback='both'))
+        self.cache_manager.start()
+        self.tts_streaming = config.getboolean('polly', 'streaming', fallback=False)
+        self.time_to_first_audio = deque(maxlen=100)
+
+        # announcements synthesize speech on this pool while the chime plays
+        self.tts_executor = ThreadPoolExecutor(
+            max_workers=config.getint('polly', 'max_concurrency', fallback=2),
+            thread_name_prefix="tts")
+        self.stats_interval = config.getint('general', 'stats_interval', fallback=60)
+        self.metrics_file = config.get('general', 'metrics_file', fallback='metrics.prom')
+
+        # identical messages arriving within this many seconds play once
+        self.coalesce_window = config.getfloat('general', 'coalesce_window', fallback=1.0)
+        self.recent_messages = {}
+        self.coalesced = 0
+
+        self.templates = TemplatedSpeech(self.tts, self.tts_executor,
+            config.getint('general', 'template_crossfade_ms', fallback=30))
+        self.announcement_gap = config.getfloat('general', 'announcement_gap', fallback=0.0)
+        self.announcement_timeout = config.getfloat('general', 'announcement_timeout', fallback=10.0)
+
+        # client_id must differ between bridges sharing a broker; it also 
+        #  names the persistent session the broker keeps for us, holding 
+        #  QoS 1 messages that arrive while we are disconnected
+        self.mqttc = mqtt.Client(config.get('mqtt', 'client_id', fallback='hmi-audio'),
+            clean_session=False)
         
         self.mqttc.on_connect = self.on_connect
+        self.mqttc.on_disconnect = self.on_disconnect
         self.mqttc.on_message = self.on_message
+        self.mqttc.will_set(f"{MQTT_TOPIC_PREFIX}/status", "offline", qos=1, retain=True)
+
+        # connection state; see run_mqtt
+        self.reconnect_min = config.getfloat('mqtt', 'reconnect_min', fallback=1.0)
+        self.reconnect_max = config.getfloat('mqtt', 'reconnect_max', fallback=60.0)
+        self.unhealthy_after = config.getfloat('mqtt', 'unhealthy_after', fallback=0.0)
+        self.mqtt_connected = False
+        self.mqtt_socket_open = False
+        self.reconnect_attempt = 0
+        self.disconnected_at = monotonic()
+        self.connected_at = None
+        self.disconnects = 0
+        self.reconnects = 0
+        self.last_outage = None
+        # systemd asks for WATCHDOG=1 every WATCHDOG_USEC; ping at half that
+        self.watchdog_interval = int(os.environ.get("WATCHDOG_USEC", 20000000)) / 2e6
+        self.watchdog_sent = 0
+        self.healthy = True
+
+        self.federation = None
+        if config.getboolean('federation', 'enabled', fallback=False):
+            self.federation = TtsFederation(self.mqttc, self.tts.database, self.audio_format,
+                config.get('federation', 'node_id', fallback=socket.gethostname()),
+                config.get('federation', 'topic_prefix', fallback='audiobridge/tts'),
+                config.getfloat('federation', 'timeout', fallback=2.0),
+                config.getfloat('federation', 'miss_timeout', fallback=0.3),
+                config.getint('federation', 'chunk_kb', fallback=32) * 1024,
+                config.getboolean('federation', 'prefetch', fallback=False))
+            self.federation.inflight = self.tts.inflight
+            self.tts.federation = self.federation
 
         # self.mqttc.username_pw_set(
         #     config['mqtt']['username'], 
         #     config['mqtt']['password'])
         
-        self.mqttc.connect(config['mqtt']['host'])
-        
-        # set a default volume
-        self.master_volume = 30
+        # connected by run_mqtt, so a broker that is down at startup does 
+        #  not keep us from coming up
+        self.mqttc.connect_async(config['mqtt']['host'], 
+            config.getint('mqtt', 'port', fallback=1883),
+            config.getint('mqtt', 'keepalive', fallback=30))
+        self.startup_mark("mqtt setup")
         
-        # volume set requests are generally set as retain
-        # we do not want to announce a volume change on start of this script
-        self.volume_is_set = False
+        self.normalize_rms = config.getfloat('general', 'normalize_rms', fallback=0.0)
+        self.vol_absolute_max = int(config['general']['vol_absolute_max'])
+        self.library_loudness = {}
+
+        # audio/<broadcast_zone>/... plays in every zone together; each zone
+        #  waits up to broadcast_sync seconds for the others to be ready
+        self.broadcast_zone = config.get('general', 'broadcast_zone', fallback='all')
+        self.broadcast_sync = config.getfloat('general', 'broadcast_sync', fallback=2.0)
+        self.zone_context = threading.local()
+        self.zones = self.create_zones()
+        self.startup_mark("zones")
         
-        # Initialize USB Sound Card - Remove Mute and set volume to 100%
-        # troubleshoot: aplay -l
-        # Onboard sound card is cardindex=0
-        # HACK TO FIND THE CARD! C-Media USB Sound card has a mixer 
-        #  called "Auto Gain Control"
-        cardindex = None
+        if not self.zones:
+            print("unable to find soundcard!")
+            exit()
+        self.default_zone = next(iter(self.zones.values()))
+
+        # OK, we made it..
+        # TODO: check if mqtt is connected
+        sd.notify("READY=1")
+        logger.info("ready in %.3fs (%s)" % (monotonic() - self.startup_started,
+            ", ".join("%s %.3fs" % phase for phase in self.startup_timings.items())))
+
+        # counting cache files is only informational; keep it off the 
+        #  startup path
+        threading.Thread(target=self.log_cache_stats, name="cache-stats", 
+            daemon=True).start()
+
+    def startup_mark(self,phase):
+        now = monotonic()
+        self.startup_timings[phase] = now - self.startup_phase_started
+        self.startup_phase_started = now
+
+    def log_cache_stats(self):
+        files = sum(1 for f in Path(self.sounds_cache_path).iterdir())
+        logger.info(f"cache path: {self.sounds_cache_path} ({files} files)")
+
+    # Initialize the sound card of each zone - Remove Mute and set volume to 
+    #  100%. Zones whose card cannot be found are skipped.
+    # troubleshoot: aplay -l
+    def create_zones(self):
+        zones = {}
+        if not self.zone_sections:
+            # Onboard sound card is cardindex=0
+            cardindex = self.find_soundcard()
+            if cardindex is None:
+                return zones
+            zones["default"] = OutputZone("default",
+                config.get('general', 'pcm_device', fallback='default'),
+                cardindex, self.audio_format,
+                config.get('output', 'sink', fallback='alsa'),
+                config.get('output', 'file', fallback='output.wav'))
+            return zones
+
         cards = alsa.cards()
+        for section in self.zone_sections:
+            name = section[len("zone:"):]
+            if name in ZONE_RESERVED_NAMES or name == self.broadcast_zone or "/" in name:
+                logger.error("zone name '%s' clashes with a topic; skipping" % name)
+                continue
+            card = config.get(section, 'card', fallback=None)
+            if card is None:
+                cardindex = config.getint(section, 'cardindex', fallback=0)
+            elif card in cards:
+                cardindex = cards.index(card)
+            else:
+                logger.error("zone %s: sound card '%s' not found (have %s); skipping" 
+                    % (name, card, ", ".join(cards)))
+                continue
+            try:
+                zones[name] = OutputZone(name,
+                    config.get(section, 'pcm_device', fallback='default'),
+                    cardindex, self.audio_format,
+                    config.get(section, 'sink', fallback=config.get('output', 'sink', fallback='alsa')),
+                    config.get(section, 'file', fallback='output-%s.wav' % name),
+                    cardindex,
+                    config.get(section, 'master_control', fallback='Master'),
+                    config.get(section, 'device_control', fallback='Speaker'))
+            except Exception as e:
+                logger.error("zone %s: unable to open outputs: %s" % (name, e.__repr__()))
+                continue
+            logger.info("zone %s: card %d (%s), device '%s'" % (name, cardindex, 
+                cards[cardindex] if cardindex < len(cards) else "?", zones[name].pcm_device))
+        return zones
+
+    # zone of the playback worker running the current request
+    @property
+    def zone(self):
+        return getattr(self.zone_context, "zone", None) or self.default_zone
+
+    # HACK TO FIND THE CARD! C-Media USB Sound card has a mixer called 
+    #  "Auto Gain Control". The index and name of the card found are saved so
+    #  the next start only has to confirm that one card instead of 
+    #  enumerating the mixers of every card.
+    def find_soundcard(self):
+        cache_file = Path(CACHE_PATH) / "soundcard.json"
+        cards = alsa.cards()
+        try:
+            cached = json.loads(cache_file.read_text())
+            cardindex = cached["cardindex"]
+            if (cardindex < len(cards) and cards[cardindex] == cached["card"] and 
+                    "Auto Gain Control" in alsa.mixers(cardindex=cardindex)):
+                logger.debug("using cached soundcard %d (%s)" % (cardindex, cached["card"]))
+                return cardindex
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+
+        cardindex = None
         for i in range(len(cards)):
             mixers = alsa.mixers(cardindex=i)
             for control in mixers:
                 if control == "Auto Gain Control":
                     cardindex = i
-        
-        if cardindex is None:
-            print("unable to find soundcard!")
-            exit()
-
-        # Set Mute OFF and device volume to 100%
-        self.device_mixer = alsa.Mixer(control="Speaker", cardindex=cardindex)
-        self.device_mixer.setmute(0)
-        self.device_mixer.setvolume(100)
-
-        # unmute master mixer and set volume to default
-        self.master_mixer = alsa.Mixer(control="Master")
-        self.master_mixer.setmute(0)
-        self.master_mixer.setvolume(self.master_volume)
+        if cardindex is not None:
+            cache_file.write_text(json.dumps({"cardindex": cardindex, 
+                "card": cards[cardindex]}))
+        return cardindex
 
-        masterRange = self.master_mixer.getrange()
-        deviceRange = self.device_mixer.getrange()
+    def stats(self):
+        stats = {
+            "sound_index": self.sound_index.stats(),
+            "pcm_cache": self.wave_cache.stats(),
+            "sound_cache": self.sound_converter.stats(),
+            "disk_cache": self.cache_manager.stats(),
+            "tts": self.tts_stats(),
+            "templates": self.templates.stats(),
+            "coalesce": {"messages_merged": self.coalesced},
+            "synthesis": self.tts.inflight.stats(),
+            "mqtt": self.mqtt_stats(),
+        }
+        if self.federation:
+            stats["federation"] = self.federation.stats()
+        # the default zone keeps the unsuffixed names
+        for zone in self.zones.values():
+            suffix = "" if zone is self.default_zone else "_%s" % zone.name
+            stats["scheduler" + suffix] = zone.scheduler.stats()
+            if zone.mixer:
+                stats["mixer" + suffix] = zone.mixer.stats()
+        return stats
 
-        # OK, we made it..
-        # TODO: check if mqtt is connected
-        sd.notify("READY=1")
+    # every stats_interval seconds: publish stage histograms and component 
+    #  counters to {MQTT_TOPIC_PREFIX}/stats and rewrite the metrics file
+    def report_stats(self):
+        while True:
+            sleep(self.stats_interval)
+            try:
+                components = self.stats()
+                self.mqttc.publish(f"{MQTT_TOPIC_PREFIX}/stats", json.dumps({
+                    "stages": metrics.summary(), "components": components}))
+                if self.metrics_file:
+                    metrics.write_prometheus(self.metrics_file, components)
+            except Exception as e:
+                logger.error("unable to report stats: %s" % e.__repr__())
 
     def start(self):
 
         logger.info("Starting MQTT Audio Bridge")
+        if self.stats_interval:
+            threading.Thread(target=self.report_stats, name="stats", daemon=True).start()
         try:
-            self.mqttc.loop_forever()
-        except:
+            self.run_mqtt()
+        except KeyboardInterrupt:
             logger.info("shutting down")
+            self.mqttc.publish(f"{MQTT_TOPIC_PREFIX}/status", "offline", qos=1, retain=True)
+            self.mqttc.disconnect()
+
+    # Runs the paho network loop on this thread and keeps the connection up.
+    #  After a failed connect or a dropped connection, attempts back off 
+    #  exponentially from reconnect_min to reconnect_max seconds with full
+    #  jitter, so bridges do not all hit a restarted broker at once. Playback
+    #  runs on the zone workers and carries on in the meantime.
+    def run_mqtt(self):
+        while True:
+            if not self.mqtt_socket_open:
+                try:
+                    self.mqttc.reconnect()
+                    self.mqtt_socket_open = True
+                except Exception as e:
+                    self.backoff("unable to connect to MQTT broker (%s)" % e.__repr__())
+                    continue
+            try:
+                rc = self.mqttc.loop(timeout=1.0)
+            except Exception as e:
+                logger.error("mqtt loop error: %s" % e.__repr__())
+                rc = -1
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                # dropped, or refused at CONNACK; the attempt count is only
+                #  reset by a successful on_connect
+                self.mqtt_socket_open = False
+                self.mark_disconnected()
+                self.backoff("MQTT connection lost (result code %s)" % rc)
+                continue
+            self.watchdog()
+
+    def backoff(self,reason):
+        self.reconnect_attempt += 1
+        delay = random.uniform(0, min(self.reconnect_max, 
+            self.reconnect_min * 2 ** self.reconnect_attempt))
+        logger.warning("%s; retrying in %.1fs" % (reason, delay))
+        self.idle(delay)
+
+    # sleep without starving the watchdog
+    def idle(self,seconds):
+        deadline = monotonic() + seconds
+        while monotonic() < deadline:
+            sleep(min(1.0, max(0.0, deadline - monotonic())))
+            self.watchdog()
+
+    def mark_disconnected(self):
+        if self.mqtt_connected:
+            self.mqtt_connected = False
+            self.disconnected_at = monotonic()
+            self.disconnects += 1
+            sd.notify("STATUS=disconnected from MQTT broker; reconnecting")
+
+    # healthy while every playback worker and mixer is running. A broker 
+    #  outage is not a fault of ours and a restart would cut off playback, so
+    #  it only counts when unhealthy_after (seconds) is set
+    def health(self):
+        if (self.unhealthy_after and not self.mqtt_connected and 
+                monotonic() - self.disconnected_at > self.unhealthy_after):
+            return False, "broker unreachable for %.0fs" % (monotonic() - self.disconnected_at)
+        for zone in self.zones.values():
+            if not zone.scheduler.worker.is_alive():
+                return False, "zone %s: playback worker stopped" % zone.name
+            if zone.mixer and not zone.mixer.alive():
+                return False, "zone %s: mixer stopped" % zone.name
+        if not self.sound_index.alive():
+            return False, "sound index watcher stopped"
+        return True, "ok"
+
+    # systemd restarts the bridge when WATCHDOG=1 stops arriving 
+    #  (WatchdogSec in the unit file)
+    def watchdog(self):
+        now = monotonic()
+        if now - self.watchdog_sent < self.watchdog_interval:
+            return
+        self.watchdog_sent = now
+        healthy, reason = self.health()
+        if healthy:
+            sd.notify("WATCHDOG=1")
+        elif self.healthy:
+            logger.error("unhealthy, withholding watchdog: %s" % reason)
+            sd.notify("STATUS=unhealthy: %s" % reason)
+        self.healthy = healthy
+
+    def mqtt_stats(self):
+        now = monotonic()
+        return {
+            "connected": int(self.mqtt_connected),
+            "healthy": int(self.healthy),
+            "disconnects": self.disconnects,
+            "reconnects": self.reconnects,
+            "last_outage_seconds": self.last_outage or 0.0,
+            "state_seconds": now - (self.connected_at if self.mqtt_connected 
+                else self.disconnected_at),
+        }
             
     def get_tts_waveform(self,text,volume=None,voice=None):
 
         logger.info("speech requested for text='%s', vol=%s, voice=%s" 
             % (text,volume,voice))
-        tts = Polly()
-        speech_waveform = tts.get_waveform(text,voice)
+        speech_waveform = self.tts.get_waveform(text,voice)
         
         return speech_waveform
 
@@ -341,12 +3544,111 @@ class AudioBridge():
 
         if volume == None:
             volume = baseVolume
+        if self.tts_streaming and not self.tts.cached_waveform(text,voice):
+            if self.stream_speech(text,volume,voice):
+                return
         waveform = self.get_tts_waveform(text,volume,voice)
-        self.play_sound(waveform + ".wav", volume)
+        self.play_sound(waveform + ".wav", volume, "speech")
+
+    # speak a template such as "volume {volume}" from separately cached 
+    #  fragments; see TemplatedSpeech
+    def speak_template(self,template,values,volume=None,voice=None):
+
+        if volume == None:
+            volume = baseVolume
+        logger.info("templated speech requested for '%s' %s, vol=%s, voice=%s" 
+            % (template,values,volume,voice))
+        wave_obj = self.templates.render(template,values,voice)
+        if wave_obj:
+            self.play_wave(wave_obj, getScaledVolume(volume), "speech")
+
+    # play a phrase that is not yet cached while polly is still sending it;
+    #  False if it was not streamed because another request is already 
+    #  synthesizing it (or a peer had it), leaving the caller to play the 
+    #  cached entry
+    def stream_speech(self,text,volume=None,voice=None):
+
+        logger.info("streaming speech for text='%s', vol=%s, voice=%s" 
+            % (text,volume,voice))
+        requested = monotonic()
+        first_audio = None
+
+        stream = self.tts.stream_waveform(text,voice)
+        first = next(stream, None)
+        if first is None:
+            return False
+
+        zone = self.zone
+        volume = getScaledVolume(volume)
+        gain = volume / self.vol_absolute_max if self.vol_absolute_max else 1.0
+        output = None
+        remainder = b""
+        exhausted = False
+        try:
+            if not zone.software_gain:
+                zone.set_volume(volume, True)
+            if zone.mixer:
+                output = zone.mixer.stream(PCM_SAMPLE_RATE, 1, gain, "speech")
+                zone.scheduler.attach(output)
+                write = lambda pcm: zone.mixer.feed_stream(output, pcm)
+            else:
+                output = alsa.PCM(type=alsa.PCM_PLAYBACK, device=zone.pcm_device,
+                    rate=PCM_SAMPLE_RATE, channels=1, format=alsa.PCM_FORMAT_S16_LE,
+                    periodsize=PCM_CHUNK_SIZE // 2)
+                if zone.software_gain and gain != 1.0:
+                    write = lambda pcm: output.write(apply_gain(pcm, gain))
+                else:
+                    write = output.write
+            for chunk in itertools.chain([first], stream):
+                if zone.scheduler.cancelled():
+                    break
+                # alsa wants whole frames
+                chunk = remainder + chunk
+                usable = len(chunk) - (len(chunk) % 2)
+                remainder = chunk[usable:]
+                if not usable:
+                    continue
+                if first_audio is None:
+                    first_audio = monotonic() - requested
+                    self.time_to_first_audio.append(first_audio)
+                    logger.info("time to first audio: %.3fs for '%s'" % (first_audio, text))
+                write(chunk[:usable])
+            else:
+                exhausted = True
+            if zone.mixer:
+                output.close()
+                zone.scheduler.wait(output)
+            elif hasattr(output, 'drain'):
+                output.drain()
+        finally:
+            if not exhausted:
+                # preempted (or the output failed): finish the cache entry 
+                #  in the background so the preempting request plays now 
+                #  and requests waiting on the phrase still get it
+                threading.Thread(target=deque, args=(stream, 0), 
+                    name="tts-drain", daemon=True).start()
+            if output is not None:
+                output.close()
+            if not zone.software_gain:
+                zone.restore_volume()
+        return True
+
+    def tts_stats(self):
+        samples = sorted(self.time_to_first_audio)
+        if not samples:
+            return {"streamed": 0}
+        return {
+            "streamed": len(samples),
+            "ttfa_avg": sum(samples) / len(samples),
+            "ttfa_p50": samples[len(samples) // 2],
+            "ttfa_max": samples[-1],
+        }
 
     # case and suffix insensitive
     # prefer wav but accept other formats
-    def play_sound(self,req_sound,reqVolume):
+    # duck_class tags the sound for the mixer's ducking rules; with the mixer
+    #  a background sound is started without waiting for it to finish
+    def play_sound(self,req_sound,reqVolume,duck_class="foreground",background=False):
 
         filepath = None
 
@@ -357,173 +3659,461 @@ class AudioBridge():
             filepath = req_sound
             
         else:
-            # search local data path for a filename matching base
-            for localfile in Path(SOUNDS_PATH).rglob('*'):
-                # match base names
-                if req_sound.lower() == localfile.stem.lower():
-                    filepath = localfile
-                    if filepath.suffix[1:] in SUPPORTED_FORMATS:
-                        logger.debug("located a sound file in supported format: %s" % localfile)
-                        break
+            # look up the sound library index for a filename matching base
+            with metrics.timer("sound_lookup"):
+                filepath = self.sound_index.lookup(req_sound)
+            if filepath and filepath.suffix[1:] in SUPPORTED_FORMATS:
+                logger.debug("located a sound file in supported format: %s" % filepath)
             
             if not filepath:
                 logger.info("could not locate a suitable sound file for '%s'" % req_sound)
                 return True
             
-            if filepath and filepath.suffix[1:] not in SUPPORTED_FORMATS:
-                logger.debug("located a file as conversion candidate: %s" % filepath)
-                # convert file to preferred format and write to cache path
-                target_file = "%s/%s.%s" % (self.sounds_cache_path,req_sound,PREFERRED_FORMAT)
-                if convert_audio_file(filepath,target_file):
+            # anything not already in the output format plays from the cache
+            if self.sound_converter.needs_conversion(filepath):
+                filepath = self.sound_converter.cached(filepath)
+                if not filepath:
                     logger.error("error converting sound file")
                     return True
-            
-                filepath = target_file
-                
-            # check if we have already converted this file
 
         if filepath:
+            if self.zone.scheduler.cancelled():
+                logger.info(f"skipping '{filepath}'; request was preempted")
+                return True
             logger.info(f"playing audio file '{filepath}' at volume {volume}")
-            if volume != None:
-                self.set_volume(volume, True)
             #  SimpleAudio WaveObject 
             try:
-                wave_obj = simpleaudio.WaveObject.from_wave_file(str(filepath))
-                play_obj = wave_obj.play()            
-                play_obj.wait_done() # wait until sound has finished playing
+                with metrics.timer("pcm_cache_lookup"):
+                    wave_obj = (self.tts.database.packed_wave(filepath) or 
+                        self.wave_cache.get(filepath, Path(req_sound).stem))
+                self.play_wave(wave_obj, volume, duck_class, background, filepath)
             except Exception as e:
                 logger.error("error playing file: %s" % e.__repr__())
         else:
             logger.error("could not locate a sound file for '%s'!" % req_sound)
 
-        if volume:
-            self.restore_volume()
+    # play a WaveObject at a scaled volume; filepath (if any) is used to look
+    #  up stored loudness for normalization
+    def play_wave(self,wave_obj,volume,duck_class="foreground",background=False,filepath=None):
+
+        zone = self.zone
+        if zone.mixer:
+            gain = self.playback_gain(filepath, volume)
+            if background:
+                zone.mixer.play(wave_obj, gain, duck_class)
+                return
+            zone.scheduler.play(wave_obj, 
+                lambda w: zone.mixer.play(w, gain, duck_class))
+            return
+
+        mixer_changed = False
+        if zone.software_gain and wave_obj.bytes_per_sample == 2:
+            wave_obj = self.scale_wave(wave_obj, self.playback_gain(filepath, volume))
+        elif volume != None:
+            zone.set_volume(volume, True)
+            mixer_changed = True
+        try:
+            # wait until sound has finished playing (or is preempted)
+            zone.scheduler.play(wave_obj)
+        finally:
+            if mixer_changed:
+                zone.restore_volume()
+
+    # linear gain for a scaled (mixer percentage) volume relative to the 
+    #  mixer level used in software gain mode, optionally normalizing the 
+    #  file's rms towards normalize_rms without letting its peak clip
+    def playback_gain(self,filepath,volume):
+        gain = volume / self.vol_absolute_max if self.vol_absolute_max else 1.0
+        if self.normalize_rms and filepath:
+            loudness = self.loudness(filepath)
+            if loudness and loudness["rms"] > 0:
+                normal = self.normalize_rms / loudness["rms"]
+                if loudness["peak"] > 0:
+                    normal = min(normal, 1.0 / loudness["peak"])
+                gain *= normal
+        return gain
+
+    # stored loudness of a cached file; library wavs are measured on first
+    #  use and remembered for the life of the process
+    def loudness(self,filepath):
+        filepath = Path(filepath)
+        if filepath.parent == Path(self.sounds_cache_path):
+            return self.sound_converter.loudness(filepath)
+        if filepath.parent == Path(self.tts.database.tts_cache_path):
+            tts = self.tts.database.entry_for_file(filepath)
+            return tts if tts and "rms" in tts else None
+        mtime = os.stat(filepath).st_mtime
+        cached = self.library_loudness.get(filepath)
+        if not cached or cached[0] != mtime:
+            cached = (mtime, measure_loudness(filepath))
+            self.library_loudness[filepath] = cached
+        return cached[1]
+
+    @staticmethod
+    def scale_wave(wave_obj,gain):
+        if gain == 1.0:
+            return wave_obj
+        return simpleaudio.WaveObject(apply_gain(wave_obj.audio_data, gain),
+            wave_obj.num_channels, wave_obj.bytes_per_sample, wave_obj.sample_rate)
+
+    # start the alert sound straight away and synthesize the speech while it
+    #  plays; speech follows the chime after announcement_gap seconds, or is
+    #  skipped if synthesis has not finished announcement_timeout seconds 
+    #  after the chime ends (it still completes into the cache)
+    # with overlap (mixer only) speech starts as soon as it is ready, over the
+    #  alert sound, which is ducked beneath it
+    def announce(self,sound,text,volume=None,voice=None,overlap=False):
+
+        if volume == None:
+            volume = self.zone.master_volume
+        overlap = overlap and self.zone.mixer is not None
+        pending = self.tts_executor.submit(self.get_tts_waveform,text,volume,voice)
+        self.play_sound(sound,float(volume)*0.8,"alert",background=overlap)
+        chime_done = monotonic()
+
+        try:
+            tts_waveform = pending.result(timeout=self.announcement_timeout)
+        except FutureTimeoutError:
+            logger.warning("speech for announcement '%s' not ready %.1fs after "
+                "the alert sound; skipping" % (text, self.announcement_timeout))
+            return True
+
+        remaining = self.announcement_gap - (monotonic() - chime_done)
+        if remaining > 0 and not overlap:
+            sleep(remaining)
+        self.play_sound("%s.wav" % tts_waveform,volume,"speech")
+
+    # retained messages on reconnect and double-fired automations deliver the
+    #  same payload several times in quick succession; only the first counts
+    def is_duplicate(self,topic,payload):
+        if not self.coalesce_window:
+            return False
+        now = monotonic()
+        for key, seen in list(self.recent_messages.items()):
+            if now - seen > self.coalesce_window:
+                del self.recent_messages[key]
+        key = (topic, payload)
+        if key in self.recent_messages:
+            self.coalesced += 1
+            return True
+        self.recent_messages[key] = now
+        return False
+
+    # hand a request to the playback worker; ttl and priority may come from
+    #  the json payload ("ttl": seconds, "priority": urgent|high|normal|low)
+    # zones defaults to the default zone; a request for several zones waits
+    #  (up to broadcast_sync seconds) in each until all are ready to start
+    def enqueue(self,description,fn,payload_json=None,priority=PRIORITY_NORMAL,zones=None):
+
+        ttl = self.request_ttl
+        if payload_json:
+            ttl = float(payload_json.get("ttl", ttl))
+            priority = PRIORITIES.get(str(payload_json.get("priority", "")).lower(), priority)
+
+        zones = zones or [self.default_zone]
+        barrier = threading.Barrier(len(zones)) if len(zones) > 1 else None
+        for zone in zones:
+            if len(self.zones) > 1:
+                zone_description = "[%s] %s" % (zone.name, description)
+            else:
+                zone_description = description
+            request = PlaybackRequest(
+                lambda request, zone=zone: self.run_in_zone(zone, fn, barrier),
+                zone_description, priority, ttl)
+            zone.scheduler.submit(request)
+
+    def run_in_zone(self,zone,fn,barrier=None):
+        self.zone_context.zone = zone
+        try:
+            if barrier:
+                try:
+                    barrier.wait(self.broadcast_sync)
+                except threading.BrokenBarrierError:
+                    logger.info("zone %s: starting broadcast without the other zones" 
+                        % zone.name)
+            fn()
+        finally:
+            self.zone_context.zone = None
+
+    # audio/<zone>/... is for that zone, audio/<broadcast_zone>/... for every
+    #  zone and anything else for the default zone; returns the zones and the
+    #  topic with the zone removed
+    def route(self,topic):
+        parts = topic.split("/")
+        if len(parts) > 2:
+            if parts[1] == self.broadcast_zone:
+                return list(self.zones.values()), "/".join(parts[:1] + parts[2:])
+            if parts[1] in self.zones:
+                return [self.zones[parts[1]]], "/".join(parts[:1] + parts[2:])
+        return [self.default_zone], topic
 
     # The callback for when the client receives a CONNACK response from the server.
+    #  Subscriptions are renewed on every connect even when the broker kept
+    #  the session, since the set we need (e.g. federation) may have changed.
     def on_connect(self,client, userdata, flags, rc):
         if rc==0:
-            logger.info(f"Connected to MQTT broker {config['mqtt']['host']}:{config['mqtt']['port']}")
+            logger.info("Connected to MQTT broker %s:%d" % (config['mqtt']['host'],
+                config.getint('mqtt', 'port', fallback=1883)))
+            now = monotonic()
+            if self.connected_at is not None:
+                self.last_outage = now - self.disconnected_at
+                self.reconnects += 1
+                metrics.observe("mqtt_reconnect", self.last_outage)
+                logger.info("reconnected after %.1fs" % self.last_outage)
+            self.mqtt_connected = True
+            self.connected_at = now
+            self.reconnect_attempt = 0
             subscription = f"{MQTT_TOPIC_PREFIX}/#"
-            self.mqttc.subscribe(subscription)
+            self.mqttc.subscribe(subscription, qos=1)
             logger.info(f"Subscribed to: {subscription}")
+            if self.federation:
+                self.federation.subscribe()
+            self.mqttc.publish(f"{MQTT_TOPIC_PREFIX}/status", "online", qos=1, retain=True)
+            sd.notify("STATUS=connected to MQTT broker")
         else:
             logger.error("ERROR connecting to MQTT with result code " + str(rc))
 
-    def restore_volume(self):
-        # only set volume if it is not currently what we are looking for
-        if self.master_mixer.getvolume()[0] != self.master_volume:
-            logger.debug(f"master_mixer.setvolume -> {self.master_volume}")
-            self.master_mixer.setvolume(self.master_volume)
-
-    def set_volume(self,value,temp=False):
-        
-        if isinstance(value,str):
-            value = int(float(value))
-
-        if isinstance(value,float):
-            value = int(value)
-
-        if value >= 0 and value <= 100:
-            self.master_mixer.setvolume(value)
-            if not temp:
-                self.master_volume = value
-        else:
-            logger.error("ERROR: cannot set volume to '%s'. Must be between 0 and 1." % value)
+    def on_disconnect(self,client,userdata,rc):
+        if rc != 0:
+            logger.warning("disconnected from MQTT broker (result code %s)" % rc)
+        self.mark_disconnected()
 
     # The callback for when a PUBLISH message is received from the server.
     def on_message(self,client,userdata,msg):
+        set_trace_id(new_trace_id())
+        try:
+            with metrics.timer("receive"):
+                self.handle_message(msg)
+        finally:
+            set_trace_id(None)
+
+    def handle_message(self,msg):
+        # our own stats and status come back to us through the audio/# 
+        #  subscription
+        if msg.topic in (f"{MQTT_TOPIC_PREFIX}/stats", f"{MQTT_TOPIC_PREFIX}/status"):
+            return
         try:
             payload = msg.payload.decode('utf-8')
             
             logger.debug(f"received mqtt: topic={msg.topic}; payload={payload}")
-            
+
+            zones, topic = self.route(msg.topic)
+
+            # only playback requests are merged; state such as the volume 
+            #  must always take the latest value
+            if (topic.startswith(COALESCED_TOPICS) and 
+                    self.is_duplicate(msg.topic, payload)):
+                logger.info(f"ignoring duplicate of a recent message; topic={msg.topic}")
+                return
+
             volume = None
             payload_json = None
 
-            if "/json" in msg.topic:
+            if "/json" in topic:
                 # JSON Topics
                 try:
                     payload_json = json.loads(payload)
-                except JSONDecodeError as e:
-                    logger.error("error decoding: %e" % e.__repr__())
+                except json.JSONDecodeError as e:
+                    logger.error("error decoding: %s" % e.__repr__())
                     return
                     
                 if not payload:
                     logger.info(f"warning! no payload; topic={msg.topic}")
                     return
 
-                # common elements
+                # common elements; announcements default to the zone's 
+                #  master volume
                 volume = payload_json.get("volume", None)
-                if volume == None:
-                    volume = self.master_volume
                 
+                # presynthesize/json - warm the tts cache; see send_phrases
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/presynthesize"):
+                    phrases = [(p["text"], p.get("voice"), bool(p.get("ssml", False)))
+                        for p in payload_json.get("phrases", []) if p.get("text")]
+                    presynthesizer = Presynthesizer(self.tts, 
+                        config.getint('polly', 'max_concurrency', fallback=2),
+                        float(payload_json.get("rate", 5.0)))
+                    threading.Thread(target=presynthesizer.run, args=(phrases,),
+                        name="presynthesis", daemon=True).start()
+                    return
+
                 # announcement/json
-                if msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/announcement"):
-                    try:
-                        sound = payload_json.get("sound")
-                        text = payload_json.get("text")
-                        voice = payload_json.get("voice", None)
-                    except:
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/announcement"):
+                    sound = payload_json.get("sound")
+                    text = payload_json.get("text")
+                    voice = payload_json.get("voice", None)
+                    if not sound or not text:
                         logger.error("unable to find required parameters in json: %s" % payload)
+                        return
                     
-                    # obtain tts waveform prior to playing the announcement 
-                    #  alert sound to eliminate possible delays
-                    tts_waveform = self.get_tts_waveform(text,volume,voice)
-                    self.play_sound(sound,float(volume)*0.8)
-                    self.play_sound("%s.wav" % tts_waveform,volume)
+                    overlap = bool(payload_json.get("overlap", False))
+                    self.enqueue("announcement '%s'" % text,
+                        lambda: self.announce(sound,text,volume,voice,overlap),
+                        payload_json, PRIORITY_HIGH, zones=zones)
+
+                # speak/template/json
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/speak/template"):
+                    template = payload_json.get("template")
+                    values = payload_json.get("values", {})
+                    voice = payload_json.get("voice",None)
+                    volume = payload_json.get("volume",None)
+                    if not template:
+                        logger.error("no template in json: %s" % payload)
+                        return
+                    self.enqueue("speak template '%s'" % template,
+                        lambda: self.speak_template(template,values,volume,voice),
+                        payload_json, zones=zones)
+                    return
 
                 # speech/json
-                if (msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/speak") or 
-                        msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/speech")):
+                if (topic.startswith(f"{MQTT_TOPIC_PREFIX}/speak") or 
+                        topic.startswith(f"{MQTT_TOPIC_PREFIX}/speech")):
                     text = payload_json.get("text","no text specified")
                     voice = payload_json.get("voice",None)
                     volume = payload_json.get("volume",None)
-                    self.speak(text,volume,voice)
+                    self.enqueue("speak '%s'" % text,
+                        lambda: self.speak(text,volume,voice), payload_json,
+                        zones=zones)
 
                 # play/json
-                if msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/play"):
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/play"):
                     name = payload_json.get("name")
                     volume = payload_json.get("volume",None)
-                    self.play_sound(name,volume)
+                    if payload_json.get("background", False):
+                        self.enqueue("play '%s' in background" % name,
+                            lambda: self.play_sound(name,volume,"background",True),
+                            payload_json, zones=zones)
+                    else:
+                        self.enqueue("play '%s'" % name,
+                            lambda: self.play_sound(name,volume), payload_json,
+                            zones=zones)
 
             else:
                 # non-JSON messages (dictated by topic)
                 # SET VOLUME - topic_prefix/set/volume -> 55
-                if msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/set/volume"):
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/set/volume"):
                     
                     volume = int(payload)
-                    self.set_volume(volume)
+                    for zone in zones:
+                        zone.set_volume(volume)
                     
-                    if self.volume_is_set:
-                        self.speak("volume %d" % volume)
-                    else:
-                        self.volume_is_set = True
+                        # a retained volume is redelivered on every fresh
+                        #  subscription; only announce live changes
+                        if zone.volume_is_set and not msg.retain:
+                            self.enqueue("speak 'volume %d'" % volume,
+                                lambda: self.speak_template("volume {volume}", 
+                                    {"volume": volume}), zones=[zone])
+                        else:
+                            zone.volume_is_set = True
                 
                 # Speak -- TTS
                 # speak/speech (duplicate below)
-                if msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/speak"):
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/speak"):
                     topic_prefix = f"{MQTT_TOPIC_PREFIX}/speak"
-                    pos = msg.topic.rfind("/")
+                    pos = topic.rfind("/")
                     if pos == len(topic_prefix):
-                        volume = int(msg.topic.split("/")[-1])
-                    self.speak(payload,volume)
-                if msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/speech"):
+                        volume = int(topic.split("/")[-1])
+                    self.enqueue("speak '%s'" % payload,
+                        lambda: self.speak(payload,volume), zones=zones)
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/speech"):
                     topic_prefix = f"{MQTT_TOPIC_PREFIX}/speech"
-                    pos = msg.topic.rfind("/")
+                    pos = topic.rfind("/")
                     if pos == len(topic_prefix):
-                        volume = int(msg.topic.split("/")[-1])
-                    self.speak(payload,volume)
+                        volume = int(topic.split("/")[-1])
+                    self.enqueue("speak '%s'" % payload,
+                        lambda: self.speak(payload,volume), zones=zones)
 
-                if msg.topic.startswith(f"{MQTT_TOPIC_PREFIX}/play"):
+                if topic.startswith(f"{MQTT_TOPIC_PREFIX}/play"):
                     topic_prefix = f"{MQTT_TOPIC_PREFIX}/play"
-                    pos = msg.topic.rfind("/")
+                    pos = topic.rfind("/")
                     if pos == len(topic_prefix):
-                        volume = int(msg.topic.split("/")[-1])
-                    self.play_sound(payload,volume)
+                        volume = int(topic.split("/")[-1])
+                    self.enqueue("play '%s'" % payload,
+                        lambda: self.play_sound(payload,volume), zones=zones)
 
         except:
-            logger.error("on_message() error:", sys.exc_info()[0])
+            logger.error("on_message() error: %s" % sys.exc_info()[0])
+
+
+if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="MQTT Audio Bridge")
+    parser.add_argument("--verify-conversion", nargs="+", metavar="FILE",
+        help="compare streaming and buffered conversion of FILE(s) and exit")
+    parser.add_argument("--pack-import", action="store_true",
+        help="move cached TTS wavs into the pack store and exit")
+    parser.add_argument("--pack-export", action="store_true",
+        help="write packed TTS audio back out as wav files and exit")
+    parser.add_argument("--rerender", action="store_true",
+        help="convert cached sounds and TTS audio to the output format and exit")
+    parser.add_argument("--presynthesize", metavar="FILE",
+        help="synthesize the phrases listed in FILE into the TTS cache and exit")
+    parser.add_argument("--jobs", type=int, default=4,
+        help="concurrent polly requests for --presynthesize (default 4)")
+    parser.add_argument("--rate", type=float, default=5.0,
+        help="polly requests per second for --presynthesize (default 5)")
+    parser.add_argument("--endpoint-url",
+        help="polly endpoint for --presynthesize, e.g. a local stub")
+    args = parser.parse_args()
+
+    if args.verify_conversion:
+        results = [verify_conversion(f) for f in args.verify_conversion]
+        sys.exit(0 if all(results) else 1)
+
+    # these rewrite the TTS database and need the bridge to be stopped
+    if args.pack_import or args.pack_export:
+        pack = PackStore("%s/pack" % CACHE_PATH,
+            config.getint('cache', 'pack_size_mb', fallback=64) * 1024 * 1024)
+        try:
+            database = TtsWaveformDatabase(TTS_WAVEFORM_DB_PATH,
+                TTS_WAVEFORM_LEGACY_DB_PATH, pack)
+        except TtsDatabaseLocked as e:
+            logger.error("%s; stop the bridge first" % e)
+            sys.exit(1)
+        if args.pack_import:
+            logger.info("packed %d tts entries" % database.import_to_pack())
+        else:
+            logger.info("unpacked %d tts entries" % database.export_from_pack())
+        pack.compact()
+        sys.exit(0)
+
+    # after a change of output device; run with the bridge stopped so the 
+    #  device can be queried
+    if args.rerender:
+        # the database lock also tells us the bridge is stopped, so take it
+        #  before the format or any cache is touched
+        try:
+            database = open_tts_database()
+        except TtsDatabaseLocked as e:
+            logger.error("%s; stop the bridge first" % e)
+            sys.exit(1)
+        audio_format = negotiate_output_format(output_device())
+        SoundConverter(SOUNDS_PATH, "%s/sounds" % CACHE_PATH,
+            config.getint('general', 'conversion_workers', fallback=0) or None,
+            audio_format).convert_all()
+        logger.info("re-rendered %d tts entries to %s" 
+            % (database.rerender(audio_format), audio_format))
+        sys.exit(0)
+
+    if args.presynthesize:
+        phrases = Presynthesizer.read_phrases(args.presynthesize)
+        try:
+            tts = Polly(
+                region=config.get('polly', 'region', fallback='us-west-2'),
+                endpoint_url=args.endpoint_url or config.get('polly', 'endpoint_url', fallback=None),
+                max_concurrency=args.jobs,
+                audio_format=negotiate_output_format(output_device()))
+        except TtsDatabaseLocked as e:
+            # the bridge is running; it synthesizes into its own database
+            logger.info("%s; sending %d phrases to the running bridge" % (e, len(phrases)))
+            Presynthesizer.send_phrases(phrases, args.rate)
+            sys.exit(0)
+        counts = Presynthesizer(tts, args.jobs, args.rate).run(phrases)
+        tts.database.flush_access()
+        sys.exit(1 if counts["failed"] else 0)
 
-bridge = AudioBridge()
-bridge.start()
\ No newline at end of file
+    try:
+        bridge = AudioBridge()
+    except TtsDatabaseLocked as e:
+        logger.error("%s; is another bridge running here?" % e)
+        sys.exit(1)
+    bridge.start()
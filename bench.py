@@ -0,0 +1,582 @@
+#!venv/bin/python3
+
+# Offline benchmark for the audio bridge
+#
+# Drives AudioBridge.on_message with synthetic load without a broker, AWS
+#  or sound hardware:
+#  - an in-process stand-in for the paho MQTT client
+#  - a stubbed Polly client that returns canned audio after a configurable
+#    delay
+#  - a fake ALSA module (mixers only) with the mixer writing to a null sink
+#
+# Runs every profile against fresh sound/cache directories under a temp dir,
+#  reports throughput, p50/p99 latency (message received -> request finished)
+#  and memory, and compares the results with a stored baseline.
+#
+# usage: bench.py [--profile burst] [--polly-delay 0.2] [--save-baseline]
+#
+# bench.py --serve-polly PORT instead runs the canned audio as a local HTTP
+#  stand-in for the polly endpoint, e.g. for app.py --presynthesize:
+#   AWS_ACCESS_KEY_ID=stub AWS_SECRET_ACCESS_KEY=stub \
+#     app.py --presynthesize phrases.txt --endpoint-url http://localhost:PORT
+#
+# bench.py --federation checks TTS cache federation between two nodes 
+#  connected through an in-process broker stand-in
+#
+# bench.py --conversion checks that streaming conversion writes the same 
+#  bytes as buffered conversion across a range of formats
+
+import sys
+import os
+import io
+import json
+import wave
+import array
+import math
+import argparse
+import tempfile
+import threading
+import queue
+import random
+import resource
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import sleep, monotonic
+
+REPO_PATH = Path(__file__).resolve().parent
+BASELINE_FILE = REPO_PATH / "bench_baseline.json"
+
+CONFIG = """
+[general]
+base_volume = 50
+vol_absolute_min = 20
+vol_absolute_max = 90
+stats_interval = 0
+coalesce_window = 0
+playback_queue_size = 1024
+playback_ttl = 0
+metrics_file =
+
+[mqtt]
+host = localhost
+port = 1883
+
+[output]
+engine = mixer
+sink = null
+period_frames = 512
+buffer_periods = 2
+
+[cache]
+budget_mb = 0
+"""
+
+# short tone as 16-bit mono wav bytes
+def make_wav(duration=0.05, sample_rate=16000, frequency=440):
+    samples = array.array('h', (int(8000 * math.sin(2 * math.pi * frequency * n / sample_rate))
+        for n in range(int(duration * sample_rate))))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue(), samples.tobytes()
+
+# -- stand-ins
+
+class FakeMessage():
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+        self.qos = 0
+        self.retain = False
+
+# implements the parts of paho.mqtt.client.Client the bridge uses; published
+#  messages are recorded rather than sent anywhere
+class FakeMqttClient():
+
+    def __init__(self, *args, **kwargs):
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.published = []
+
+    def __getattr__(self, name):
+        # settings and loop control the benchmark does not care about
+        return lambda *args, **kwargs: 0
+
+    def connect(self, *args, **kwargs):
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    def subscribe(self, *args, **kwargs):
+        return (0, 1)
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        self.published.append((topic, payload))
+
+# topic filter matching with + and # wildcards
+def topic_matches(subscription, topic):
+    sub_parts = subscription.split("/")
+    parts = topic.split("/")
+    for n, part in enumerate(sub_parts):
+        if part == "#":
+            return True
+        if n >= len(parts) or (part != "+" and part != parts[n]):
+            return False
+    return len(sub_parts) == len(parts)
+
+# delivers published messages to the subscribed BrokerClients from its own
+#  thread, as a broker and the paho network loop would; corrupt flips a byte
+#  in payloads on matching topics to exercise integrity checks
+class FakeBroker():
+
+    def __init__(self):
+        self.clients = []
+        self.corrupt = None
+        self.queue = queue.Queue()
+        threading.Thread(target=self.deliver, name="broker", daemon=True).start()
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if self.corrupt and topic_matches(self.corrupt, topic) and payload:
+            payload = payload[:-1] + bytes([payload[-1] ^ 0xff])
+        self.queue.put((topic, payload))
+
+    def deliver(self):
+        while True:
+            topic, payload = self.queue.get()
+            for client in list(self.clients):
+                client.deliver(topic, payload)
+
+class BrokerClient(FakeMqttClient):
+
+    def __init__(self, broker, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.broker = broker
+        self.subscriptions = set()
+        self.callbacks = []
+        broker.clients.append(self)
+
+    def subscribe(self, topic, *args, **kwargs):
+        self.subscriptions.add(topic)
+        return (0, 1)
+
+    def message_callback_add(self, subscription, callback):
+        self.callbacks.append((subscription, callback))
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        self.broker.publish(topic, payload)
+
+    def deliver(self, topic, payload):
+        if not any(topic_matches(s, topic) for s in self.subscriptions):
+            return
+        message = FakeMessage(topic, payload)
+        for subscription, callback in self.callbacks:
+            if topic_matches(subscription, topic):
+                callback(self, None, message)
+                return
+        if self.on_message:
+            self.on_message(self, None, message)
+
+class StubAudioStream():
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+    def iter_chunks(self, chunk_size=1024):
+        for chunk in iter(lambda: self.data.read(chunk_size), b""):
+            yield chunk
+
+    def close(self):
+        pass
+
+# canned audio in place of synthesize_speech; the "ogg" is really a wav,
+#  which miniaudio decodes all the same
+class StubPollyClient():
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self.wav, self.pcm = make_wav(0.3)
+
+    def describe_voices(self, **kwargs):
+        return {"Voices": []}
+
+    def synthesize_speech(self, **kwargs):
+        self.calls += 1
+        sleep(self.delay)
+        data = self.pcm if kwargs.get("OutputFormat") == "pcm" else self.wav
+        return {"AudioStream": StubAudioStream(data)}
+
+# the synthesize_speech and describe_voices REST calls boto3 makes; a share
+#  of requests (error_rate) fail with a 500 to exercise client retries
+class StubPollyHandler(BaseHTTPRequestHandler):
+
+    polly = None
+    error_rate = 0.0
+
+    def do_GET(self):
+        self.reply(200, json.dumps({"Voices": []}).encode(), "application/json")
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if random.random() < self.error_rate:
+            self.reply(500, json.dumps({"message": "stub failure"}).encode(),
+                "application/json", {"x-amzn-ErrorType": "ServiceFailureException"})
+            return
+        data = self.polly.synthesize_speech(**request)["AudioStream"].read()
+        self.reply(200, data, "audio/ogg", 
+            {"x-amzn-RequestCharacters": str(len(request.get("Text", "")))})
+
+    def reply(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve_polly(port, delay, error_rate):
+    StubPollyHandler.polly = StubPollyClient(delay)
+    StubPollyHandler.error_rate = error_rate
+    server = ThreadingHTTPServer(("localhost", port), StubPollyHandler)
+    print(f"stub polly listening on http://localhost:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{StubPollyHandler.polly.calls} synthesize requests served")
+
+class FakeMixer():
+
+    def __init__(self, *args, **kwargs):
+        self.volume = 100
+
+    def setmute(self, mute):
+        pass
+
+    def setvolume(self, volume):
+        self.volume = volume
+
+    def getvolume(self):
+        return [self.volume]
+
+    def getrange(self):
+        return (0, 100)
+
+# mixer control only; the mixer engine plays through its null sink
+class FakeAlsa():
+
+    PCM_PLAYBACK = 0
+    PCM_FORMAT_S16_LE = 2
+    Mixer = FakeMixer
+
+    @staticmethod
+    def cards():
+        return ["Benchmark"]
+
+    @staticmethod
+    def mixers(cardindex=0):
+        return ["Master", "Speaker", "Auto Gain Control"]
+
+# -- load profiles; each returns a list of (topic, payload)
+
+def profile_burst(count):
+    return [("audio/play", "tone%d" % (n % 8)) for n in range(count)]
+
+def profile_speech(count):
+    return [("audio/speak", "phrase number %d" % (n % 16)) for n in range(count)]
+
+def profile_mixed(count):
+    messages = []
+    for n in range(count):
+        kind = n % 4
+        if kind == 0:
+            messages.append(("audio/play", "tone%d" % (n % 8)))
+        elif kind == 1:
+            messages.append(("audio/speak", "mixed phrase %d" % (n % 10)))
+        elif kind == 2:
+            messages.append(("audio/announcement/json", json.dumps(
+                {"sound": "tone1", "text": "announcement %d" % (n % 5), "volume": 40})))
+        else:
+            messages.append(("audio/speak/template/json", json.dumps(
+                {"template": "temperature is {value} degrees", "values": {"value": n % 40}})))
+    return messages
+
+PROFILES = {
+    "burst": profile_burst,
+    "speech": profile_speech,
+    "mixed": profile_mixed,
+}
+
+# -- harness
+
+class Bench():
+
+    def __init__(self, workdir, polly_delay):
+
+        self.workdir = Path(workdir)
+        sounds = self.workdir / "sounds"
+        sounds.mkdir(parents=True, exist_ok=True)
+        for n in range(8):
+            wav, pcm = make_wav(0.05, 16000, 300 + 50 * n)
+            (sounds / ("tone%d.wav" % n)).write_bytes(wav)
+        (self.workdir / "config.ini").write_text(CONFIG)
+
+        # app reads config.ini from the working directory on import
+        os.chdir(self.workdir)
+        sys.path.insert(0, str(REPO_PATH))
+        import app
+        self.app = app
+
+        app.SOUNDS_PATH = str(sounds)
+        app.CACHE_PATH = str(sounds / "cache")
+        app.TTS_WAVEFORM_DB_PATH = str(self.workdir / "database.jsonl")
+        app.TTS_WAVEFORM_LEGACY_DB_PATH = str(self.workdir / "database.json")
+        app.mqtt.Client = FakeMqttClient
+        app.alsa = FakeAlsa
+        self.polly = StubPollyClient(polly_delay)
+        app.boto3.client = lambda *args, **kwargs: self.polly
+
+        self.bridge = app.AudioBridge()
+        self.latencies = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.instrument()
+
+    # time each request from on_message to the end of its playback
+    def instrument(self):
+        enqueue = self.bridge.enqueue
+        def timed_enqueue(description, fn, *args, **kwargs):
+            received = self.received
+            def run():
+                try:
+                    fn()
+                finally:
+                    with self.lock:
+                        self.latencies.append(monotonic() - received)
+                        self.pending -= 1
+            with self.lock:
+                self.pending += 1
+            return enqueue(description, run, *args, **kwargs)
+        self.bridge.enqueue = timed_enqueue
+
+    def drain(self, timeout):
+        deadline = monotonic() + timeout
+        while self.pending > 0 and monotonic() < deadline:
+            sleep(0.01)
+        return self.pending <= 0
+
+    def run(self, messages, timeout=300):
+        self.latencies = []
+        self.pending = 0
+        polly_calls = self.polly.calls
+        tracemalloc.start()
+        started = monotonic()
+        for topic, payload in messages:
+            self.received = monotonic()
+            self.bridge.on_message(self.bridge.mqttc, None, FakeMessage(topic, payload))
+        completed = self.drain(timeout)
+        elapsed = monotonic() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        latencies = sorted(self.latencies)
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+        return {
+            "messages": len(messages),
+            "completed": len(latencies),
+            "timed_out": not completed,
+            "seconds": round(elapsed, 3),
+            "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+            "p50": percentile(0.50),
+            "p99": percentile(0.99),
+            "polly_calls": self.polly.calls - polly_calls,
+            "peak_traced_mb": round(peak / 1048576, 2),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+# three nodes with their own tts databases; nodes a and c hold a phrase 
+#  that node b then asks for: once intact, once with a corrupted transfer and
+#  once for a phrase nobody has. Each request for the phrase is answered by
+#  one holder only.
+def check_federation(workdir):
+
+    workdir = Path(workdir)
+    (workdir / "config.ini").write_text(CONFIG)
+    os.chdir(workdir)
+    sys.path.insert(0, str(REPO_PATH))
+    import app
+
+    broker = FakeBroker()
+    nodes = {}
+    for name in ("a", "b", "c"):
+        app.CACHE_PATH = str(workdir / name)
+        database = app.TtsWaveformDatabase(str(workdir / name / "database.jsonl"))
+        federation = app.TtsFederation(BrokerClient(broker), database, app.AudioFormat(1, 16000),
+            name, timeout=1.0, miss_timeout=0.3, chunk_size=4096)
+        federation.subscribe()
+        nodes[name] = federation
+
+    text, voice, engine, text_type = "the front door is open", "Joanna", "neural", "text"
+    key = app.TtsWaveformDatabase.key(text, voice, engine, text_type)
+    wav, pcm = make_wav(0.5, 16000)
+    for name in ("a", "c"):
+        holder = nodes[name].database
+        filename_base = holder.next_filename()
+        Path(filename_base + ".wav").write_bytes(wav)
+        holder.add_tts(text, filename_base, ["wav"], voice, engine, text_type, 
+            audio_format=app.AudioFormat(1, 16000))
+        nodes[name].announce(key, text, voice, engine, text_type)
+    sleep(0.1)
+
+    results = {}
+    requester = nodes["b"]
+
+    broker.corrupt = "audiobridge/tts/node/#"
+    results["corrupted transfer rejected"] = requester.fetch(key, text, voice, engine, text_type) is None
+    broker.corrupt = None
+
+    fetched = requester.fetch(key, text, voice, engine, text_type)
+    results["entry received"] = fetched is not None
+    if fetched:
+        received = bytes(requester.database.read_pcm(fetched)[0])
+        results["audio identical"] = received == pcm
+        results["entry cached"] = requester.database.get_tts(text, voice, engine, text_type) == fetched
+
+    started = monotonic()
+    missing = requester.fetch("0" * 40, "nobody has this", voice, engine, text_type)
+    results["unknown phrase times out"] = missing is None and monotonic() - started < 1.0
+    sleep(0.1)
+    results["one holder answers each request"] = (nodes["a"].served + nodes["c"].served) == 2
+
+    for check, passed in results.items():
+        print(f"{'ok  ' if passed else 'FAIL'} {check}")
+    for name, node in nodes.items():
+        print(f"node {name}: " + json.dumps(node.stats()))
+    return all(results.values())
+
+# source formats (channels, rate, seconds) converted to each target format 
+#  by both converters; lengths are not whole chunks so the tails are covered
+CONVERSION_SOURCES = [(2, 48000, 3.1), (1, 22050, 2.7), (2, 8000, 1.3), (1, 44100, 0.9)]
+CONVERSION_TARGETS = [(1, 44100), (2, 48000), (1, 16000)]
+
+# noisy two-tone 16-bit wav of the given format
+def make_test_wav(filename, channels, sample_rate, duration):
+    rng = random.Random(channels * sample_rate)
+    samples = array.array('h')
+    for n in range(int(duration * sample_rate)):
+        for channel in range(channels):
+            value = 12000 * math.sin(2 * math.pi * (440 + 200 * channel) * n / sample_rate)
+            samples.append(int(value + rng.uniform(-1500, 1500)))
+    with wave.open(str(filename), 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.tobytes())
+
+# the streaming converter must write exactly what the buffered one does
+def check_conversion(workdir):
+
+    workdir = Path(workdir)
+    (workdir / "config.ini").write_text(CONFIG)
+    os.chdir(workdir)
+    sys.path.insert(0, str(REPO_PATH))
+    import app
+
+    results = {}
+    for channels, sample_rate, duration in CONVERSION_SOURCES:
+        source = workdir / f"{channels}ch_{sample_rate}.wav"
+        make_test_wav(source, channels, sample_rate, duration)
+        for target_channels, target_rate in CONVERSION_TARGETS:
+            check = f"{channels}ch/{sample_rate}Hz -> {target_channels}ch/{target_rate}Hz"
+            results[check] = app.verify_conversion(source, target_channels, target_rate)
+
+    for check, passed in results.items():
+        print(f"{'ok  ' if passed else 'FAIL'} {check}")
+    return all(results.values())
+
+# percentage change of each comparable figure against the baseline
+def compare(results, baseline):
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"{name}: no baseline")
+            continue
+        changes = []
+        for key in ("throughput", "p50", "p99", "peak_traced_mb"):
+            if result.get(key) is None or not base.get(key):
+                continue
+            change = (result[key] - base[key]) / base[key] * 100
+            changes.append(f"{key} {change:+.1f}%")
+        print(f"{name} vs baseline: " + ", ".join(changes))
+
+def main():
+
+    parser = argparse.ArgumentParser(description="offline audio bridge benchmark")
+    parser.add_argument("--profile", choices=sorted(PROFILES), action="append",
+        help="profile(s) to run; default all")
+    parser.add_argument("--count", type=int, default=40, help="messages per run")
+    parser.add_argument("--polly-delay", type=float, default=0.2,
+        help="seconds the stub polly takes per request")
+    parser.add_argument("--baseline", default=str(BASELINE_FILE))
+    parser.add_argument("--save-baseline", action="store_true",
+        help="store these results as the new baseline")
+    parser.add_argument("--serve-polly", type=int, metavar="PORT",
+        help="run the stub polly endpoint on PORT instead of benchmarking")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+        help="share of stub polly requests that fail")
+    parser.add_argument("--federation", action="store_true",
+        help="check tts cache federation between two nodes instead of benchmarking")
+    parser.add_argument("--conversion", action="store_true",
+        help="check streaming conversion matches buffered conversion instead of benchmarking")
+    args = parser.parse_args()
+
+    if args.conversion:
+        with tempfile.TemporaryDirectory(prefix="audioconv-") as workdir:
+            sys.exit(0 if check_conversion(workdir) else 1)
+
+    if args.federation:
+        with tempfile.TemporaryDirectory(prefix="audiofed-") as workdir:
+            sys.exit(0 if check_federation(workdir) else 1)
+
+    if args.serve_polly:
+        serve_polly(args.serve_polly, args.polly_delay, args.error_rate)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="audiobench-") as workdir:
+        bench = Bench(workdir, args.polly_delay)
+        # let the background sound conversion and polly warm-up finish
+        sleep(1)
+
+        results = {}
+        for name in args.profile or sorted(PROFILES):
+            messages = PROFILES[name](args.count)
+            # the first pass starts with an empty tts cache, the second
+            #  replays the same messages against the warm cache
+            for phase in ("cold", "warm"):
+                result = bench.run(messages)
+                results[f"{name}/{phase}"] = result
+                print(f"{name}/{phase}: " + json.dumps(result))
+
+    baseline_file = Path(args.baseline)
+    if baseline_file.exists():
+        compare(results, json.loads(baseline_file.read_text()))
+    if args.save_baseline:
+        baseline_file.write_text(json.dumps(results, indent=4))
+        print(f"baseline saved to {baseline_file}")
+
+if __name__ == "__main__":
+    main()